@@ -1,10 +1,12 @@
 import click
 import os
 from graph_tool.all import load_graph
-from graf_seguidors import build_followers_subgraph
+from bsky import BskyError
+from graf_seguidors import build_followers_subgraph, update_followers_subgraph
 from graf_interaccio_threads import _get_client_threads, build_interaction_graph
-from comunitats import main as comunitats_main
-from pagerank import main as pagerank_main
+from dibuix import dibuixa_seguidors, dibuixa_threads
+from comunitats import main as comunitats_main, NUM_INICIS, NUM_ESCOMBRADES
+from pagerank import main as pagerank_main, MODES as MODES_CENTRALITATS, NUM_PIVOTS
 from propagacio_threads import main as propagacio_main
 from vertex_sortida import identifica_seguidors_valuosos
 
@@ -24,6 +26,20 @@ def neteja_handle(handle: str) -> str:
     )
 
 
+def avisa_error_api(error: BskyError, graf: str, comprovacio: str) -> None:
+    """
+    Informa d'un error de l'API en construir un graf de l'usuari: si és un error de la petició (4xx, ex: handle inexistent), demana comprovar el handle; si no (5xx o error de xarxa que ha persistit després dels reintents), mostra l'error tal qual.
+    """
+    if 400 <= error.status < 500 and error.status != 429:
+        print(
+            f"Advertència: el graf de {graf} està buit ({error}). Comprova el handle i que l'usuari {comprovacio}."
+        )
+    else:
+        print(
+            f"Error: no s'ha pogut obtenir el graf de {graf} ({error}). Torna-ho a provar més tard."
+        )
+
+
 @click.command()
 @click.option(
     "--handle",
@@ -47,64 +63,145 @@ def neteja_handle(handle: str) -> str:
     default="completa",
     help="Tipus d'anàlisi a fer",
 )
-def analitza(handle: str, analisi: str):
+@click.option(
+    "--actualitza/--no-actualitza",
+    default=False,
+    help="Actualitza incrementalment el graf de seguidors existent (només els seguidors nous i els que han marxat)",
+)
+@click.option(
+    "--dibuixa/--no-dibuixa",
+    default=True,
+    help="Dibuixa els grafs de seguidors, de threads i de comunitats (la disposició es desa en una memòria cau al costat del .gt i es reutilitza)",
+)
+@click.option(
+    "--inicis-sbm",
+    default=NUM_INICIS,
+    show_default=True,
+    help="Inferències SBM independents per detectar comunitats, en paral·lel si n'hi ha més d'una (es queda la de menor longitud de descripció)",
+)
+@click.option(
+    "--processos",
+    type=int,
+    default=None,
+    help="Processos treballadors per a les inferències SBM (per defecte, un per nucli)",
+)
+@click.option(
+    "--escombrades",
+    default=NUM_ESCOMBRADES,
+    show_default=True,
+    help="Escombrades MCMC opcionals per refinar cada partició SBM",
+)
+@click.option(
+    "--mode-centralitats",
+    type=click.Choice(MODES_CENTRALITATS),
+    default="auto",
+    show_default=True,
+    help="Betweenness i closeness exactes o aproximades per mostreig de pivots ('auto' aproxima en grafs grans)",
+)
+@click.option(
+    "--pivots",
+    default=NUM_PIVOTS,
+    show_default=True,
+    help="Vèrtexs pivot de la mostra per a les centralitats aproximades (més pivots, més precisió i més temps)",
+)
+@click.option(
+    "--fils-openmp",
+    type=int,
+    default=None,
+    help="Fils OpenMP de graph-tool per a cada centralitat (per defecte, els nuclis repartits entre les tres)",
+)
+def analitza(
+    handle: str,
+    analisi: str,
+    actualitza: bool,
+    dibuixa: bool,
+    inicis_sbm: int,
+    processos: int | None,
+    escombrades: int,
+    mode_centralitats: str,
+    pivots: int,
+    fils_openmp: int | None,
+):
     """
     Orquestra el pipeline d'anàlisi de xarxa social per a un usuari de Bluesky.
     Segons el tipus d'anàlisi seleccionat, executa els diferents mòduls i desa els resultats a la carpeta corresponent.
-    Mostra avisos si algun graf és buit o si hi ha problemes amb les dades.
+    Mostra avisos si algun graf és buit o si hi ha problemes amb les dades (ex: si l'API no troba el handle, s'avisa i s'ometen les anàlisis que en depenen).
     """
     handle = neteja_handle(handle)
     carpeta = os.path.join("resultats", handle)
     os.makedirs(carpeta, exist_ok=True)
     fitxer_seguidors = os.path.join(carpeta, f"{handle}_followers.gt")
     fitxer_threads = os.path.join(carpeta, f"{handle}_threads.gt")
+    error_seguidors = error_threads = False
 
     # SEGUIDORS
     if analisi in ["seguidors", "completa", "comunitats", "pagerank"]:
-        if not os.path.isfile(fitxer_seguidors):
-            print("Creant graf de seguidors...")
-            build_followers_subgraph(handle)
-        else:
-            print("Graf de seguidors ja existeix.")
-        if os.path.isfile(fitxer_seguidors):
+        try:
+            if not os.path.isfile(fitxer_seguidors):
+                print("Creant graf de seguidors...")
+                build_followers_subgraph(handle)
+            elif actualitza:
+                print("Actualitzant el graf de seguidors...")
+                update_followers_subgraph(handle)
+            else:
+                print("Graf de seguidors ja existeix.")
+        except BskyError as e:
+            if os.path.isfile(fitxer_seguidors):
+                print(
+                    f"Advertència: no s'ha pogut actualitzar el graf de seguidors ({e}). Es fa servir el graf existent."
+                )
+            else:
+                error_seguidors = True
+                avisa_error_api(e, "seguidors", "tingui seguidors")
+        if os.path.isfile(fitxer_seguidors) and not error_seguidors:
             g = load_graph(fitxer_seguidors)
             if g.num_vertices() == 0:
                 print(
                     "Advertència: el graf de seguidors està buit. Comprova el handle i que l'usuari tingui seguidors."
                 )
+            elif dibuixa:
+                print("Dibuixant graf de seguidors...")
+                dibuixa_seguidors(handle)
 
     # THREADS
     if analisi in ["threads", "completa", "propagacio"]:
-        if not os.path.isfile(fitxer_threads):
-            print("Creant graf de threads...")
-            threads = _get_client_threads(handle)
-            g = build_interaction_graph(threads, handle)
-        else:
-            print("Graf de threads ja existeix.")
-        if os.path.isfile(fitxer_threads):
+        try:
+            if not os.path.isfile(fitxer_threads):
+                print("Creant graf de threads...")
+                threads = _get_client_threads(handle)
+                g = build_interaction_graph(threads, handle)
+            else:
+                print("Graf de threads ja existeix.")
+        except BskyError as e:
+            error_threads = True
+            avisa_error_api(e, "threads", "tingui activitat")
+        if os.path.isfile(fitxer_threads) and not error_threads:
             g = load_graph(fitxer_threads)
             if g.num_vertices() == 0:
                 print(
                     "Advertència: el graf de threads està buit. Comprova el handle i que l'usuari tingui activitat."
                 )
+            elif dibuixa:
+                print("Dibuixant graf de threads...")
+                dibuixa_threads(handle)
 
     # COMUNITATS
-    if analisi in ["comunitats", "completa"]:
+    if analisi in ["comunitats", "completa"] and not error_seguidors:
         print("Analitzant comunitats...")
-        comunitats_main(handle)
+        comunitats_main(handle, inicis_sbm, processos, escombrades, dibuixa)
 
     # PAGERANK , BETWEENESS, CLOSENESS
-    if analisi in ["pagerank", "completa"]:
+    if analisi in ["pagerank", "completa"] and not error_seguidors:
         print("Calculant centralitats (PageRank, Betweenness, Closeness)...")
-        pagerank_main(handle)
+        pagerank_main(handle, mode_centralitats, pivots, fils_openmp)
 
     # PROPAGACIÓ
-    if analisi in ["propagacio", "completa"]:
+    if analisi in ["propagacio", "completa"] and not error_threads:
         print("Calculant propagació de threads...")
         propagacio_main(handle)
 
     # VALUOSOS
-    if analisi in ["valuosos", "completa"]:
+    if analisi in ["valuosos", "completa"] and not (error_seguidors or error_threads):
         print("Identificant seguidors valuosos...")
         identifica_seguidors_valuosos(handle)
 
@@ -1,94 +1,204 @@
-import click, asyncio, requests_cache
-from datetime import datetime
-from dataclasses import dataclass
-from typing import Any, TypeAlias
+import click, asyncio, atexit, json, os, random, sqlite3, sys, threading, time, weakref
+import numpy as np
+from datetime import datetime, timezone
 from dataclasses import dataclass
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+    Iterator,
+    TypeAlias,
+    TypeVar,
+)
+from aiohttp import ClientError, TCPConnector
 from aiohttp_client_cache import CachedSession, SQLiteBackend
+from bsky_store import CrawlStore, STORE_MAX_BYTES, STORE_NAME, TTLS, others_key
+
+try:
+    import orjson
+
+    json_loads: Callable[[str | bytes], Any] = orjson.loads
+except ImportError:  # orjson is optional, it only makes decoding faster
+    json_loads = json.loads
 
 # Constants #######################################################################################
 
 API_HOST = "https://public.api.bsky.app"
+CACHE_NAME = "bsky_cache"
+CACHE_MAX_BYTES = 1024**3  # Compact the HTTP cache when it grows over this size
+CACHE_COMPACT_RATIO = 0.8  # Compacting leaves the cache at this fraction of the maximum
+CACHE_EXPIRE_AFTER = 24 * 3600  # seconds
+# The kind of stored entity that each NSID returns: its responses are cached for
+# as long as the store considers the entity fresh (bsky_store.TTLS)
+_NSID_ENTITIES = {
+    "app.bsky.actor.getProfiles": "profiles",
+    "app.bsky.graph.getFollowers": "followers",
+    "app.bsky.graph.getFollows": "follows",
+    "app.bsky.graph.getRelationships": "relationships",
+    "app.bsky.feed.getAuthorFeed": "posts",
+    "app.bsky.feed.getPostThread": "threads",
+}
+CACHE_URLS_EXPIRE_AFTER = {  # seconds, per NSID
+    f"*/xrpc/{nsid}": TTLS[kind] for nsid, kind in _NSID_ENTITIES.items()
+}
 GET_PROFILES_MAX_ACTORS = 25
 GET_RELATIONSHIPS_MAX_OTHERS = 30
+GET_FOLLOWS_MAX_LIMIT = 100
 GET_FEED_REQ_LIMIT = 50
 MAX_REQUESTS_IN_FLIGHT = 50
+KEEPALIVE_TIMEOUT = 30
+MAX_RETRIES = 6
+BACKOFF_BASE = 0.5  # seconds
+BACKOFF_MAX = 60.0  # seconds
 
 
-# Calling the API #################################################################################
-
 ParamValue: TypeAlias = str | int | list[str] | list[int]
 Params: TypeAlias = dict[str, ParamValue]
 
-# Global session to speed up non-async calls
-session = requests_cache.CachedSession("bsky")
 
+class BskyError(Exception):
+    """An API call that failed (after retrying, if the error was transient)."""
+
+    def __init__(self, url: str, status: int, reason: str, text: str):
+        super().__init__(f"{status} {reason} for {url}: {text}")
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.text = text
+
+
+def _is_transient(status: int) -> bool:
+    return status == 429 or status >= 500
+
+
+class _AdaptiveLimiter:
+    """A concurrency limit that adapts to the server's throttling.
+
+    The limit grows by one after `limit` consecutive successes (up to
+    `max_limit`) and halves on every 429 response. When the `RateLimit-*`
+    headers say the current window is exhausted, new requests wait until the
+    window resets.
+    """
+
+    def __init__(self, max_limit: int):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.in_flight = 0
+        self.successes = 0
+        self.resume_at = 0.0  # Unix time
+        self.condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        delay = self.resume_at - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
 
-def __call_api(nsid: str, params: Params) -> Any:
-    # print(f"{nsid}: {params}")
-    response = session.get(f"{API_HOST}/xrpc/{nsid}", params=params)
-    if not response.ok:
-        print("URL:    ", response.url)
-        print("Code:   ", response.status_code)
-        print("Reason: ", response.reason)
-        print("Text:   ", response.text)
-        return "{}"  # Valid JSON...
-    return response.json()
+    async def release(self) -> None:
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
 
+    def on_success(self) -> None:
+        self.successes += 1
+        if self.successes >= self.limit and self.limit < self.max_limit:
+            self.limit += 1
+            self.successes = 0
 
-async def __call_api_async(session, nsid: str, params: Params) -> Any:
-    # print(f"__call_api_async('{nsid}', {params})")
-    async with session.get(f"{API_HOST}/xrpc/{nsid}", params=params) as response:
-        if not response.ok:
-            print("URL:    ", response.url)
-            print("Code:   ", response.status_code)
-            print("Reason: ", response.reason)
-            print("Text:   ", response.text)
-            return "{}"  # Valid JSON...
-        return await response.json()
+    def on_throttle(self) -> None:
+        self.limit = max(1, self.limit // 2)
+        self.successes = 0
 
+    def update(self, headers) -> None:
+        remaining = headers.get("ratelimit-remaining")
+        reset = headers.get("ratelimit-reset")
+        if remaining is not None and reset is not None and int(remaining) <= 0:
+            self.resume_at = max(self.resume_at, float(reset))
 
-# Data types
+    def backoff(self, attempt: int) -> float:
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+        delay *= random.uniform(0.5, 1.5)  # Jitter
+        return max(delay, self.resume_at - time.time())
 
 
-@dataclass
+# Data types ######################################################################################
+
+
+# Timestamps are kept as the ISO strings returned by the API, and only parsed
+# (with the `created` properties) when needed.
+
+
+def _parse_time(timestamp: str) -> datetime:
+    moment = datetime.fromisoformat(timestamp)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+# Live profiles by DID, so that all the posts by the same author share one `Profile`
+_profiles: "weakref.WeakValueDictionary[str, Profile]" = weakref.WeakValueDictionary()
+
+
+@dataclass(slots=True, weakref_slot=True)
 class Profile:
     did: str
     handle: str
     displayName: str
-    createdAt: datetime
+    createdAt: str
     description: str
     followersCount: int
     followsCount: int
 
+    @property
+    def created(self) -> datetime:
+        return _parse_time(self.createdAt)
+
     @staticmethod
     def fromJson(json: Any):
-        return Profile(
-            json["did"],
-            json["handle"],
+        profile = Profile(
+            sys.intern(json["did"]),
+            sys.intern(json["handle"]),
             json["displayName"] if "displayName" in json else "",
-            json["createdAt"],
+            json["createdAt"] if "createdAt" in json else "",
             json["description"] if "description" in json else "",
             json["followersCount"] if "followersCount" in json else 0,
             json["followsCount"] if "followsCount" in json else 0,
         )
+        _profiles[profile.did] = profile
+        return profile
+
+    @staticmethod
+    def shared(json: Any):
+        """Return the live `Profile` with the DID of `json`, or create it."""
+        profile = _profiles.get(json["did"])
+        return profile if profile is not None else Profile.fromJson(json)
 
 
-@dataclass
+@dataclass(slots=True)
 class Post:
     uri: str
     author: Profile
-    createdAt: datetime
+    createdAt: str
     text: str
     replyCount: int
     repostCount: int
     likeCount: int
     quoteCount: int
 
+    @property
+    def created(self) -> datetime:
+        return _parse_time(self.createdAt)
+
     @staticmethod
     def fromJson(json: Any):
         return Post(
             json["uri"],
-            Profile.fromJson(json["author"]),
+            Profile.shared(json["author"]),
             json["record"]["createdAt"],
             json["record"]["text"],
             json["replyCount"],
@@ -98,188 +208,954 @@ class Post:
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class Repost:
     post: Post
     by: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Thread:
-    post: Post
-    replies: list["Thread"]
+    r"""A post and all its replies, flattened in depth-first (pre-)order.
+
+    `posts[0]` is the root post, `parent[i]` is the index of the post that
+    `posts[i]` replies to (-1 for the root), and `author[i]` is the index of
+    the author of `posts[i]` in `authors`. Since the posts are in pre-order,
+    a post always comes after the post it replies to.
+    """
+
+    posts: list[Post]
+    parent: np.ndarray
+    author: np.ndarray
+    authors: list[Profile]
+
+    @property
+    def post(self) -> Post:
+        return self.posts[0]
+
+    def __len__(self) -> int:
+        return len(self.posts)
+
+    def num_replies(self) -> int:
+        """The total number of replies, at any level."""
+        return len(self.posts) - 1
+
+    def depth(self) -> np.ndarray:
+        """The depth of every post (0 for the root).
+
+        Computed by pointer jumping over `parent`: each step adds the distance
+        to the current ancestor and jumps to that ancestor's, so it takes
+        O(log(max depth)) array operations.
+        """
+        depth = (self.parent >= 0).astype(np.int32)
+        ancestor = self.parent.copy()
+        while (jump := ancestor >= 0).any():
+            up = np.where(jump, ancestor, 0)
+            depth = depth + np.where(jump, depth[up], 0)
+            ancestor = np.where(jump, ancestor[up], -1)
+        return depth
 
     @staticmethod
     def fromJson(json: Any):
-        replies = json["replies"] if "replies" in json else []
+        posts: list[Post] = []
+        parent: list[int] = []
+        author: list[int] = []
+        authors: list[Profile] = []
+        author_index: dict[str, int] = {}
+        pending: list[tuple[Any, int]] = [(json, -1)]
+        while pending:
+            node, parent_index = pending.pop()
+            if "post" not in node:
+                continue  # Replies that were deleted or are blocked
+            post = Post.fromJson(node["post"])
+            if post.author.did not in author_index:
+                author_index[post.author.did] = len(authors)
+                authors.append(post.author)
+            index = len(posts)
+            posts.append(post)
+            parent.append(parent_index)
+            author.append(author_index[post.author.did])
+            replies = node["replies"] if "replies" in node else []
+            pending += [(r, index) for r in reversed(replies)]
         return Thread(
-            Post.fromJson(json["post"]),
-            [Thread.fromJson(r) for r in replies],
+            posts,
+            np.array(parent, dtype=np.int32),
+            np.array(author, dtype=np.int32),
+            authors,
         )
 
 
-# Bluesky calls ###################################################################################
+class Relationships:
+    __slots__ = ("following", "followedBy")
 
+    following: list[str]
+    followedBy: list[str]
 
-def get_follower_handles(handle: str) -> list[str]:
-    r"""Get the handles of the followers of a user.
+    def __init__(self):
+        self.following = []
+        self.followedBy = []
 
-    :param atid: The user's "handle" (e.g. "`fchollet.bsky.social`")
 
-    :returns handles: `list[str]`
-        A list of the handles of the followers of user with `handle`
+def _feed_item(json: Any) -> Post | Repost:
+    post = Post.fromJson(json["post"])
+    if "reason" in json:
+        if json["reason"]["$type"] == "app.bsky.feed.defs#reasonRepost":
+            return Repost(post, sys.intern(json["reason"]["by"]["handle"]))
+        else:
+            print("Something else?", json["reason"]["$type"])
+    return post
 
-    """
-    follower_handles: list[str] = []
-    result = __call_api(
-        "app.bsky.graph.getFollowers",
-        {"actor": handle, "limit": 100},
-    )
-    cursor = result["cursor"] if "cursor" in result else None
-    while True:
-        fhandles = result["followers"] if "followers" in result else []
-        follower_handles += [f["handle"] for f in fhandles]
-        if not cursor:
-            break
-        result = __call_api(
-            "app.bsky.graph.getFollowers",
-            {"actor": handle, "limit": 100, "cursor": cursor},
-        )
-        cursor = result["cursor"] if "cursor" in result else None
 
-    return follower_handles
+def _feed_item_time(json: Any) -> datetime:
+    # Reposts appear in the feed at the time they were reposted
+    if "reason" in json and "indexedAt" in json["reason"]:
+        return _parse_time(json["reason"]["indexedAt"])
+    return _parse_time(json["post"]["record"]["createdAt"])
 
 
-def get_followers(handle: str) -> list[Profile]:
-    return get_profiles(get_follower_handles(handle))
+def _cache_file(cache_name: str) -> str:
+    # SQLiteBackend adds the extension when the cache name has none
+    return cache_name if os.path.splitext(cache_name)[1] else f"{cache_name}.sqlite"
 
 
-def get_feed(handle: str, limit: int = 20) -> list[Post | Repost]:
-    r"""Return a limited list of Posts from a user.
+def _file_size(path: str) -> int:
+    return os.path.getsize(path) if os.path.isfile(path) else 0
 
-    :param handle: The handle of the user (e.g. "`fchollet.bsky.social`")
-    :param limit: The maximum number of posts to return (default: 20)
 
-    :returns feed: The list of `Post` or `Repost` objects
+def compact_cache(cache_name: str = CACHE_NAME, max_bytes: int = CACHE_MAX_BYTES) -> int:
+    """Evict the oldest responses of the HTTP cache until it fits in
+    `CACHE_COMPACT_RATIO * max_bytes`, and reclaim the free space.
+
+    :returns evicted: The number of responses evicted
     """
-    num_posts: int = min(limit, GET_FEED_REQ_LIMIT)
-    feed: list[Any] = []
-    data = __call_api(
-        "app.bsky.feed.getAuthorFeed", {"actor": handle, "limit": num_posts}
-    )
-    cursor = data["cursor"] if "cursor" in data else None
-    while len(feed) < limit:
-        feed += data["feed"] if "feed" in data else []
-        if not cursor:
-            break
-        data = __call_api(
-            "app.bsky.feed.getAuthorFeed",
-            {"actor": handle, "limit": num_posts, "cursor": cursor},
+    path = _cache_file(cache_name)
+    if not os.path.isfile(path):
+        return 0
+    db = sqlite3.connect(path)
+    try:
+        # Rows are rewritten on every update, so the lowest rowids are the oldest
+        cursor = db.execute(
+            """
+            DELETE FROM responses WHERE rowid <= (
+                SELECT rowid FROM (
+                    SELECT rowid, SUM(LENGTH(value)) OVER (ORDER BY rowid DESC) AS size
+                    FROM responses
+                )
+                WHERE size > ? ORDER BY rowid DESC LIMIT 1
+            )
+            """,
+            (int(max_bytes * CACHE_COMPACT_RATIO),),
         )
-        cursor = data["cursor"] if "cursor" in data else None
+        evicted = cursor.rowcount
+        db.commit()
+        [free_pages] = db.execute("PRAGMA freelist_count").fetchone()
+        [page_size] = db.execute("PRAGMA page_size").fetchone()
+        if free_pages * page_size > _file_size(path) // 10:
+            db.execute("VACUUM")
+    finally:
+        db.close()
+    return evicted
+
+
+def _chunked(seq, size):
+    return (seq[pos : pos + size] for pos in range(0, len(seq), size))
 
-    result: list[Post | Repost] = []
-    for f in feed:
-        post = Post.fromJson(f["post"])
-        if "reason" in f:
-            if f["reason"]["$type"] == "app.bsky.feed.defs#reasonRepost":
-                post = Repost(post, f["reason"]["by"]["handle"])
-            else:
-                print("Something else?", f["reason"]["$type"])
-        result.append(post)
-    return result
 
+def _num_pages(count: int, size: int) -> int:
+    return max(1, -(-count // size))
 
-def __chunked(seq, size):
-    return (seq[pos : pos + size] for pos in range(0, len(seq), size))
 
+X = TypeVar("X")
+Y = TypeVar("Y")
+
+
+class _Failed:
+    def __init__(self, error: Exception):
+        self.error = error
 
-def get_profiles(handles: list[str]) -> list[Profile]:
-    """Get the profiles of users from their IDs.
 
-    :param ids: A list of the IDs (bsky handles) for the wanted users
+_DONE = object()
 
-    :returns profiles: A list of `Profile` objects
+
+# Bluesky client ##################################################################################
+
+
+class BskyClient:
+    r"""A long-lived client for the Bluesky API.
+
+    The client owns one pooled aiohttp connector (so TLS handshakes and
+    keep-alive connections are reused between calls), one cache backend and
+    one `CrawlStore` for its whole lifetime. Every call reads the entities it
+    needs from the store first, and writes back whatever it fetches. Use it as
+    an async context manager:
+
+        async with BskyClient() as client:
+            profiles = await client.get_profiles(["fchollet.bsky.social"])
+
+    :param host: The API host (e.g. a local fake XRPC server for testing)
+    :param cache_name: The name of the SQLite cache database
+    :param store_name: The path of the `CrawlStore` database
+    :param cache_max_bytes: The size over which the HTTP cache is compacted
+        when the client is closed
+    :param store_max_bytes: The size over which the store is compacted when
+        the client is closed
+    :param max_requests_in_flight: The maximum number of concurrent requests
+        (the actual limit adapts to the server's throttling)
+    :param max_retries: How many times a request is retried on 429/5xx or
+        network errors before raising `BskyError`
     """
-    unique_handles = [h for h in set(handles)]
-    if not unique_handles:
-        return []
-
-    async def __get_profiles(groups: list[list[str]]) -> list[Profile]:
-        profiles: list[Profile] = []
-        async with CachedSession(cache=SQLiteBackend("bsky_cache")) as session:
-            for request_chunk in __chunked(groups, MAX_REQUESTS_IN_FLIGHT):
-                tasks = [
-                    asyncio.ensure_future(
-                        __call_api_async(
-                            session, "app.bsky.actor.getProfiles", {"actors": req}
-                        )
+
+    def __init__(
+        self,
+        host: str = API_HOST,
+        cache_name: str = CACHE_NAME,
+        store_name: str = STORE_NAME,
+        cache_max_bytes: int = CACHE_MAX_BYTES,
+        store_max_bytes: int = STORE_MAX_BYTES,
+        max_requests_in_flight: int = MAX_REQUESTS_IN_FLIGHT,
+        max_retries: int = MAX_RETRIES,
+    ):
+        self.host = host
+        self.cache_name = cache_name
+        self.store_name = store_name
+        self.cache_max_bytes = cache_max_bytes
+        self.store_max_bytes = store_max_bytes
+        self.max_requests_in_flight = max_requests_in_flight
+        self.max_retries = max_retries
+        self.session: CachedSession | None = None
+        self.cache: SQLiteBackend | None = None
+        self.store: CrawlStore | None = None
+        self.limiter: _AdaptiveLimiter | None = None
+        self.num_requests = 0
+        self.num_cache_hits = 0
+        self.num_store_hits = 0  # Requests avoided because the store had the answer
+        self.num_retries = 0
+
+    async def open(self) -> None:
+        connector = TCPConnector(
+            limit=self.max_requests_in_flight, keepalive_timeout=KEEPALIVE_TIMEOUT
+        )
+        self.cache = SQLiteBackend(
+            self.cache_name,
+            expire_after=CACHE_EXPIRE_AFTER,
+            urls_expire_after=CACHE_URLS_EXPIRE_AFTER,
+        )
+        self.session = CachedSession(cache=self.cache, connector=connector)
+        self.limiter = _AdaptiveLimiter(self.max_requests_in_flight)
+        self.store = CrawlStore(self.store_name)
+
+    async def close(self) -> None:
+        """Close the client. If the HTTP cache has grown over `cache_max_bytes`,
+        its expired responses are deleted and it is compacted (and the same
+        for the store and `store_max_bytes`)."""
+        over_limit = _file_size(_cache_file(self.cache_name)) > self.cache_max_bytes
+        if self.session is not None:
+            if over_limit and self.cache is not None:
+                await self.cache.delete_expired_responses()
+            await self.session.close()
+            self.session = None
+            self.cache = None
+        if over_limit:
+            compact_cache(self.cache_name, self.cache_max_bytes)
+        if self.store is not None:
+            self.store.add_stats(
+                {
+                    "requests": self.num_requests,
+                    "cache_hits": self.num_cache_hits,
+                    "store_hits": self.num_store_hits,
+                    "retries": self.num_retries,
+                }
+            )
+            self.num_requests = self.num_cache_hits = self.num_store_hits = 0
+            self.num_retries = 0
+            if self.store.size() > self.store_max_bytes:
+                self.store.compact(self.store_max_bytes)
+            self.store.close()
+            self.store = None
+
+    async def __aenter__(self) -> "BskyClient":
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def call(self, nsid: str, params: Params, fresh: bool = False) -> Any:
+        """Call an XRPC method and return the decoded JSON response.
+
+        Requests are throttled by the client's adaptive limiter. Responses
+        with status 429 or 5xx, and network errors, are retried with
+        exponential backoff and jitter (up to `max_retries` times).
+
+        :param fresh: Whether to bypass the HTTP cache (the response is
+            neither read from nor written to it)
+
+        :raises BskyError: If the request fails with a non-transient error,
+            or still fails after all the retries
+        """
+        # print(f"call('{nsid}', {params})")
+        assert self.session is not None and self.limiter is not None, (
+            "BskyClient is not open"
+        )
+        url = f"{self.host}/xrpc/{nsid}"
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire()
+            self.num_requests += 1
+            try:
+                async with self.session.get(
+                    url, params=params, expire_after=0 if fresh else None
+                ) as response:
+                    if getattr(response, "from_cache", False):
+                        self.num_cache_hits += 1
+                    else:
+                        self.limiter.update(response.headers)
+                    if response.ok:
+                        self.limiter.on_success()
+                        return await response.json(loads=json_loads)
+                    error = BskyError(
+                        str(response.url),
+                        response.status,
+                        response.reason or "",
+                        await response.text(),
                     )
-                    for req in request_chunk
-                ]
-                results = await asyncio.gather(*tasks)
-                for json in results:
-                    if json == None:
-                        continue
-                    if "profiles" in json:
-                        profiles += [Profile.fromJson(p) for p in json["profiles"]]
+            except (ClientError, asyncio.TimeoutError) as e:
+                error = BskyError(url, 0, type(e).__name__, str(e))
+            finally:
+                await self.limiter.release()
+            if error.status != 0 and not _is_transient(error.status):
+                raise error
+            if error.status == 429:
+                self.limiter.on_throttle()
+            if attempt < self.max_retries:
+                self.num_retries += 1
+                await asyncio.sleep(self.limiter.backoff(attempt))
+        raise error
+
+    async def imap(
+        self,
+        func: Callable[[X], Awaitable[Y]],
+        items: Iterable[X] | AsyncIterable[X],
+    ) -> AsyncIterator[tuple[X, Y]]:
+        """Run `func` over `items` with a sliding window of concurrent calls.
+
+        A pool of `max_requests_in_flight` workers pulls items lazily from
+        `items`, so a new call starts as soon as any other one finishes (one
+        slow response never stalls the rest). Every request also goes through
+        the client's adaptive limiter, so concurrent bulk calls share the same
+        budget.
+
+        :param func: The coroutine function to call on each item
+        :param items: The items (consumed lazily, can be an async iterable)
+
+        :returns results: An async iterator of `(item, result)` pairs, in
+            completion order. The first exception raised by `func` is re-raised.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        if isinstance(items, AsyncIterable):
+            aiterator = aiter(items)
+            lock = asyncio.Lock()  # Async generators can't be advanced concurrently
+
+            async def next_item() -> Any:
+                async with lock:
+                    return await anext(aiterator, _DONE)
+
+        else:
+            iterator = iter(items)
+
+            async def next_item() -> Any:
+                return next(iterator, _DONE)
+
+        async def worker() -> None:
+            try:
+                while (item := await next_item()) is not _DONE:
+                    queue.put_nowait((item, await func(item)))
+            except Exception as e:
+                queue.put_nowait(_Failed(e))
+            finally:
+                queue.put_nowait(_DONE)
+
+        workers = [
+            asyncio.create_task(worker()) for _ in range(self.max_requests_in_flight)
+        ]
+        try:
+            running = len(workers)
+            while running > 0:
+                entry = await queue.get()
+                if entry is _DONE:
+                    running -= 1
+                elif isinstance(entry, _Failed):
+                    raise entry.error
+                else:
+                    yield entry
+        finally:
+            for w in workers:
+                w.cancel()
+
+    async def iter_followers(
+        self, handle: str, detailed: bool = False, fresh: bool = False
+    ) -> AsyncIterator[Profile]:
+        r"""Yield the profiles of the followers of a user, page by page.
+
+        The profile views returned by `app.bsky.graph.getFollowers` don't
+        include the follower/follows counts. With `detailed=True`, every page
+        is completed with a `getProfiles` call before its profiles are yielded.
+
+        :param handle: The user's "handle" (e.g. "`fchollet.bsky.social`")
+        :param detailed: Whether to fetch the full profiles (with counts)
+        :param fresh: Whether to get the current list of followers from the
+            API, skipping both the store and the HTTP cache (e.g. to compare it
+            with an earlier crawl). The store is still updated with the result
+
+        :returns followers: An async iterator of `Profile` objects
+        """
+        assert self.store is not None, "BskyClient is not open"
+        did = self.store.resolve(handle) if not fresh else None
+        stored_dids = self.store.get_followers(did) if did is not None else None
+        if stored_dids is not None:
+            stored = self.store.get_profiles(stored_dids, detailed)
+            if len(stored) == len(set(stored_dids)):
+                self.num_store_hits += _num_pages(len(stored_dids), 100)
+                for json in stored.values():
+                    yield Profile.fromJson(json)
+                return
+            if detailed:
+                self.num_store_hits += _num_pages(len(stored_dids), 100)
+                for page_dids in _chunked(stored_dids, 100):
+                    for profile in await self.get_profiles(page_dids):
+                        yield profile
+                return
+
+        follower_dids: list[str] = []
+        params: Params = {"actor": handle, "limit": 100}
+        while True:
+            result = await self.call("app.bsky.graph.getFollowers", params, fresh)
+            page = result["followers"] if "followers" in result else []
+            self.store.put_profiles(page, detailed=False)
+            follower_dids += [f["did"] for f in page]
+            if detailed:
+                for profile in await self.get_profiles([f["did"] for f in page]):
+                    yield profile
+            else:
+                for f in page:
+                    yield Profile.fromJson(f)
+            cursor = result["cursor"] if "cursor" in result else None
+            if not cursor:
+                break
+            params = {**params, "cursor": cursor}
+        if "subject" in result:
+            # The subject's profile lets a later call resolve `handle` to the stored followers
+            self.store.put_profiles([result["subject"]], detailed=False)
+            self.store.put_followers(result["subject"]["did"], follower_dids)
+
+    async def get_follower_handles(self, handle: str) -> list[str]:
+        r"""Get the handles of the followers of a user.
+
+        :param handle: The user's "handle" (e.g. "`fchollet.bsky.social`")
+
+        :returns handles: `list[str]`
+            A list of the handles of the followers of user with `handle`
+        """
+        return [p.handle async for p in self.iter_followers(handle)]
+
+    async def get_followers(self, handle: str) -> list[Profile]:
+        return [p async for p in self.iter_followers(handle, detailed=True)]
+
+    async def iter_feed(
+        self,
+        handle: str,
+        limit: int = 20,
+        filter: str | None = None,
+        since: datetime | None = None,
+    ) -> AsyncIterator[Post | Repost]:
+        r"""Yield the Posts from a user as each page of the feed arrives.
+
+        :param handle: The handle of the user (e.g. "`fchollet.bsky.social`")
+        :param limit: The maximum number of posts to yield (default: 20)
+        :param filter: A server-side feed filter (e.g. "`posts_no_replies`")
+        :param since: Stop at the first item older than this time (naive
+            datetimes are taken as UTC)
+
+        :returns feed: An async iterator of `Post` or `Repost` objects
+        """
+        assert self.store is not None, "BskyClient is not open"
+        if since is not None and since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        count = 0
+        params: Params = {"actor": handle}
+        if filter is not None:
+            params["filter"] = filter
+        while count < limit:
+            params["limit"] = min(limit - count, GET_FEED_REQ_LIMIT)
+            data = await self.call("app.bsky.feed.getAuthorFeed", params)
+            page = data["feed"] if "feed" in data else []
+            self.store.put_posts(f["post"] for f in page)
+            for f in page:
+                if since is not None and _feed_item_time(f) < since:
+                    return
+                yield _feed_item(f)
+                count += 1
+                if count >= limit:
+                    return
+            cursor = data["cursor"] if "cursor" in data else None
+            if not cursor:
+                break
+            params = {**params, "cursor": cursor}
+
+    async def get_feed(self, handle: str, limit: int = 20) -> list[Post | Repost]:
+        r"""Return a limited list of Posts from a user.
+
+        :param handle: The handle of the user (e.g. "`fchollet.bsky.social`")
+        :param limit: The maximum number of posts to return (default: 20)
+
+        :returns feed: The list of `Post` or `Repost` objects
+        """
+        return [item async for item in self.iter_feed(handle, limit)]
+
+    async def get_profiles(self, handles: list[str]) -> list[Profile]:
+        """Get the profiles of users from their IDs.
+
+        :param handles: A list of the IDs (bsky handles or DIDs) for the wanted users
+
+        :returns profiles: A list of `Profile` objects
+        """
+        assert self.store is not None, "BskyClient is not open"
+        unique_handles = [h for h in set(handles)]
+        stored = self.store.get_profiles(unique_handles, detailed=True)
+        if stored:
+            self.num_store_hits += _num_pages(len(stored), GET_PROFILES_MAX_ACTORS)
+        profiles: list[Profile] = [Profile.fromJson(p) for p in stored.values()]
+        missing = [h for h in unique_handles if h not in stored]
+        groups = _chunked(missing, GET_PROFILES_MAX_ACTORS)
+
+        async def query(actors: list[str]) -> Any:
+            return await self.call("app.bsky.actor.getProfiles", {"actors": actors})
+
+        async for _, json in self.imap(query, groups):
+            if json == None:
+                continue
+            if "profiles" in json:
+                self.store.put_profiles(json["profiles"], detailed=True)
+                profiles += [Profile.fromJson(p) for p in json["profiles"]]
         return profiles
 
-    # Groups of max GET_PROFILES_MAX_ACTORS
-    groups = [chunk for chunk in __chunked(unique_handles, GET_PROFILES_MAX_ACTORS)]
-    return asyncio.run(__get_profiles(groups))
+    async def get_thread_json(self, uri: str) -> Any:
+        """Get the raw `app.bsky.feed.getPostThread` JSON of a post.
+
+        :param uri: The post URI (see `get_thread`)
+
+        :raises ValueError: If the post is not found or blocked
+        """
+        assert self.store is not None, "BskyClient is not open"
+        thread = self.store.get_thread(uri)
+        if thread is not None:
+            self.num_store_hits += 1
+        else:
+            result = await self.call(
+                "app.bsky.feed.getPostThread", {"uri": uri, "depth": 100}
+            )
+            thread = result["thread"]
+            self.store.put_thread(uri, thread)
+        if "post" not in thread:
+            raise ValueError(f"Thread not available ({thread['$type']}): {uri}")
+        return thread
+
+    async def get_thread(self, uri: str) -> Thread:
+        """Get a post and all its replies
+
+        :param uri: The post URI as is returned by the function `get_feed`
+                    (e.g. `at://did:plc:<user-did>/app.bsky.feed.post/<post-id>`)
+
+        :returns thread: A `Thread` object (with the replies at all levels)
+        """
+        return Thread.fromJson(await self.get_thread_json(uri))
+
+    async def iter_threads(
+        self, uris: Iterable[str] | AsyncIterable[str]
+    ) -> AsyncIterator[tuple[str, Any]]:
+        """Get many threads concurrently, yielding them as they arrive.
+
+        :param uris: The URIs of the posts (can be an async iterable, so that
+            threads are fetched while the URIs are still being produced)
+
+        :returns threads: An async iterator of `(uri, thread)` pairs in
+            completion order, where `thread` is the raw thread JSON (see
+            `get_thread_json`), or the exception raised when retrieving it
+        """
+
+        async def fetch(uri: str) -> Any:
+            try:
+                return await self.get_thread_json(uri)
+            except Exception as e:
+                return e
+
+        async for uri, result in self.imap(fetch, uris):
+            yield uri, result
+
+    async def get_threads(
+        self, uris: Iterable[str] | AsyncIterable[str]
+    ) -> tuple[list[Thread], dict[str, Exception]]:
+        """Get many threads concurrently (see `iter_threads`).
+
+        :returns threads: A tuple with the list of `Thread` objects (in
+            completion order) and a dict mapping the URI of every thread that
+            could not be retrieved to its error
+        """
+        threads: list[Thread] = []
+        errors: dict[str, Exception] = {}
+        async for uri, result in self.iter_threads(uris):
+            if isinstance(result, Exception):
+                errors[uri] = result
+            else:
+                threads.append(Thread.fromJson(result))
+        return threads, errors
+
+    async def iter_author_threads(
+        self,
+        handle: str,
+        limit: int = 500,
+        filter: str | None = "posts_no_replies",
+        since: datetime | None = None,
+        skip: Iterable[str] = (),
+    ) -> AsyncIterator[tuple[str, Any]]:
+        """Get the threads of the original posts (not reposts) of a user.
+
+        Threads are fetched while later pages of the feed are still loading.
+        The `limit`, `filter` and `since` parameters are the same as in
+        `iter_feed`.
+
+        :param skip: The URIs of posts whose threads are not wanted (e.g.
+            because they were already retrieved)
+
+        :returns threads: The same as `iter_threads`
+        """
+        skip = set(skip)
+
+        async def uris() -> AsyncIterator[str]:
+            async for item in self.iter_feed(handle, limit, filter, since):
+                if isinstance(item, Post) and item.author.handle == handle:
+                    if item.uri not in skip:
+                        yield item.uri
+
+        async for uri, result in self.iter_threads(uris()):
+            yield uri, result
+
+    async def get_author_threads(
+        self,
+        handle: str,
+        limit: int = 500,
+        filter: str | None = "posts_no_replies",
+        since: datetime | None = None,
+    ) -> tuple[list[Thread], dict[str, Exception]]:
+        """Get the threads of the original posts (not reposts) of a user
+        (see `iter_author_threads`).
+
+        :returns threads: The same as `get_threads`
+        """
+        threads: list[Thread] = []
+        errors: dict[str, Exception] = {}
+        async for uri, result in self.iter_author_threads(handle, limit, filter, since):
+            if isinstance(result, Exception):
+                errors[uri] = result
+            else:
+                threads.append(Thread.fromJson(result))
+        return threads, errors
+
+    async def get_relationships(self, did: str, others_dids: list[str]) -> Relationships:
+        relationships = await self.get_followers_relationships([did], others_dids)
+        return relationships[did]
+
+    async def iter_followers_relationships(
+        self,
+        dids: list[str],
+        others_dids: list[str] | None = None,
+        errors: dict[str, Exception] | None = None,
+    ) -> AsyncIterator[tuple[str, Relationships]]:
+        """Get the relationships of every user in `dids` with all the other users,
+        yielding each user's `Relationships` as soon as they are complete.
+
+        All the `getRelationships` queries share the client's session (and
+        cache handle) and go through its sliding-window scheduler.
+
+        :param dids: The DIDs of the users (e.g. the followers of an account)
+        :param others_dids: The DIDs to check each user against (default: `dids`)
+        :param errors: If given, the error of every user whose relationships
+            could not be (completely) retrieved is stored here under its DID.
+            Such users are still yielded, without the failed part, so that one
+            unavailable account doesn't abort the whole query
+
+        :returns relationships: An async iterator of `(did, relationships)`
+            pairs, with the relationships of `did` with the users in `others_dids`
+        """
+        assert self.store is not None, "BskyClient is not open"
+        if others_dids is None:
+            others_dids = dids
+        groups = [g for g in _chunked(others_dids, GET_RELATIONSHIPS_MAX_OTHERS)]
+        if not groups:
+            for did in dids:
+                yield did, Relationships()
+            return
+
+        # Each user's relationships with all of `others_dids` are stored as one entry
+        key = others_key(others_dids)
+        relationships: dict[str, Relationships] = {}
+        for did in dids:
+            stored = self.store.get_relationships(did, key)
+            if stored is not None:
+                self.num_store_hits += len(groups)
+                rels = Relationships()
+                rels.following, rels.followedBy = stored
+                yield did, rels
+            else:
+                relationships[did] = Relationships()
+        pending = {did: len(groups) for did in relationships}
+        failed: set[str] = set()
+
+        async def query(request: tuple[str, list[str]]) -> tuple[list[str], list[str]]:
+            did, others = request
+            try:
+                json = await self.call(
+                    "app.bsky.graph.getRelationships", {"actor": did, "others": others}
+                )
+            except BskyError as e:
+                failed.add(did)
+                if errors is not None:
+                    errors[did] = e
+                return [], []
+            rels = json["relationships"] if "relationships" in json else []
+            following = [rel["did"] for rel in rels if "following" in rel]
+            followed_by = [rel["did"] for rel in rels if "followedBy" in rel]
+            return following, followed_by
+
+        requests = ((did, others) for did in list(relationships) for others in groups)
+        async for (did, _), (following, followed_by) in self.imap(query, requests):
+            relationships[did].following += following
+            relationships[did].followedBy += followed_by
+            pending[did] -= 1
+            if pending[did] == 0:
+                rels = relationships.pop(did)
+                if did not in failed:
+                    self.store.put_relationships(
+                        did, key, rels.following, rels.followedBy
+                    )
+                yield did, rels
+
+    async def get_followers_relationships(
+        self,
+        dids: list[str],
+        others_dids: list[str] | None = None,
+        errors: dict[str, Exception] | None = None,
+    ) -> dict[str, Relationships]:
+        """Get the relationships of every user in `dids` with all the other users
+        (see `iter_followers_relationships`).
+
+        :returns relationships: A dict mapping each DID to its `Relationships`
+            with the users in `others_dids`
+        """
+        return {
+            did: rels
+            async for did, rels in self.iter_followers_relationships(
+                dids, others_dids, errors
+            )
+        }
+
+    async def iter_all_follows(
+        self, dids: list[str], errors: dict[str, Exception] | None = None
+    ) -> AsyncIterator[tuple[str, list[str]]]:
+        """Get the DIDs of the users followed by every user in `dids`, yielding
+        each user's follows as soon as they are complete.
+
+        Each user's follows are paged through `app.bsky.graph.getFollows`
+        (`GET_FOLLOWS_MAX_LIMIT` per page); different users are paged
+        concurrently through the client's sliding-window scheduler.
+
+        :param dids: The DIDs of the users
+        :param errors: If given, the error of every user whose follows could
+            not be retrieved (e.g. a deleted or suspended account) is stored
+            here under its DID. Such users are yielded with no follows, so that
+            one unavailable account doesn't abort the whole query
+
+        :returns follows: An async iterator of `(did, followed_dids)` pairs
+        """
+        assert self.store is not None, "BskyClient is not open"
+
+        async def page_follows(did: str) -> list[str]:
+            stored = self.store.get_follows(did)
+            if stored is not None:
+                self.num_store_hits += _num_pages(len(stored), GET_FOLLOWS_MAX_LIMIT)
+                return stored
+            follows: list[str] = []
+            params: Params = {"actor": did, "limit": GET_FOLLOWS_MAX_LIMIT}
+            while True:
+                try:
+                    json = await self.call("app.bsky.graph.getFollows", params)
+                except BskyError as e:
+                    if errors is not None:
+                        errors[did] = e
+                    return []
+                if "follows" in json:
+                    follows += [f["did"] for f in json["follows"]]
+                cursor = json["cursor"] if "cursor" in json else None
+                if not cursor:
+                    break
+                params = {**params, "cursor": cursor}
+            self.store.put_follows(did, follows)
+            return follows
+
+        async for did, follows in self.imap(page_follows, dids):
+            yield did, follows
+
+    async def get_all_follows(
+        self, dids: list[str], errors: dict[str, Exception] | None = None
+    ) -> dict[str, list[str]]:
+        """Get the DIDs of the users followed by every user in `dids` (see
+        `iter_all_follows`).
+
+        :returns follows: A dict mapping each DID to the list of DIDs it follows
+        """
+        return {
+            did: follows async for did, follows in self.iter_all_follows(dids, errors)
+        }
+
+
+# Synchronous API #################################################################################
+#
+# The functions below run the `BskyClient` methods on a default client that lives
+# (together with its event loop, in a background thread) until the program exits,
+# so that synchronous callers also reuse connections and the cache handle.
+
+T = TypeVar("T")
+
+_default_loop: asyncio.AbstractEventLoop | None = None
+_default_client: BskyClient | None = None
+_default_lock = threading.Lock()
+
+
+def _close_default_client() -> None:
+    if _default_loop is None or _default_client is None:
+        return
+    asyncio.run_coroutine_threadsafe(_default_client.close(), _default_loop).result()
+    _default_loop.call_soon_threadsafe(_default_loop.stop)
+
+
+def _default() -> tuple[BskyClient, asyncio.AbstractEventLoop]:
+    global _default_loop, _default_client
+    with _default_lock:
+        if _default_loop is None or _default_client is None:
+            _default_loop = asyncio.new_event_loop()
+            threading.Thread(target=_default_loop.run_forever, daemon=True).start()
+            _default_client = BskyClient()
+            asyncio.run_coroutine_threadsafe(
+                _default_client.open(), _default_loop
+            ).result()
+            atexit.register(_close_default_client)
+        return _default_client, _default_loop
+
+
+def _run(method: Callable[[BskyClient], Awaitable[T]]) -> T:
+    client, loop = _default()
+    return asyncio.run_coroutine_threadsafe(method(client), loop).result()
+
+
+def _iterate(method: Callable[[BskyClient], AsyncIterator[T]]) -> Iterator[T]:
+    client, loop = _default()
+    iterator = method(client)
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(
+                    iterator.__anext__(), loop
+                ).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        asyncio.run_coroutine_threadsafe(iterator.aclose(), loop).result()
+
+
+def iter_followers(
+    handle: str, detailed: bool = False, fresh: bool = False
+) -> Iterator[Profile]:
+    return _iterate(lambda client: client.iter_followers(handle, detailed, fresh))
+
+
+def get_follower_handles(handle: str) -> list[str]:
+    return _run(lambda client: client.get_follower_handles(handle))
+
+
+def get_followers(handle: str) -> list[Profile]:
+    return _run(lambda client: client.get_followers(handle))
+
+
+def get_feed(handle: str, limit: int = 20) -> list[Post | Repost]:
+    return _run(lambda client: client.get_feed(handle, limit))
+
+
+def get_profiles(handles: list[str]) -> list[Profile]:
+    return _run(lambda client: client.get_profiles(handles))
 
 
 def get_thread(uri: str) -> Thread:
-    """Get a post and its replies as a recursive data structure
+    return _run(lambda client: client.get_thread(uri))
 
-    :param uri: The post URI as is returned by the function `get_feed`
-                (e.g. `at://did:plc:<user-did>/app.bsky.feed.post/<post-id>`)
 
-    :returns thread: A `Thread` object (possibly containing more `Thread` objects
-        in the `replies` field)
-    """
-    result = __call_api("app.bsky.feed.getPostThread", {"uri": uri, "depth": 100})
-    return Thread.fromJson(result["thread"])
+def get_author_threads(
+    handle: str,
+    limit: int = 500,
+    filter: str | None = "posts_no_replies",
+    since: datetime | None = None,
+) -> tuple[list[Thread], dict[str, Exception]]:
+    return _run(lambda client: client.get_author_threads(handle, limit, filter, since))
 
 
-class Relationships:
-    following: list[str]
-    followedBy: list[str]
+def get_threads(uris: list[str]) -> tuple[list[Thread], dict[str, Exception]]:
+    return _run(lambda client: client.get_threads(uris))
 
-    def __init__(self):
-        self.following = []
-        self.followedBy = []
+
+def iter_author_threads(
+    handle: str,
+    limit: int = 500,
+    filter: str | None = "posts_no_replies",
+    since: datetime | None = None,
+    skip: Iterable[str] = (),
+) -> Iterator[tuple[str, Any]]:
+    return _iterate(
+        lambda client: client.iter_author_threads(handle, limit, filter, since, skip)
+    )
 
 
 def get_relationships(did: str, others_dids: list[str]) -> Relationships:
+    return _run(lambda client: client.get_relationships(did, others_dids))
 
-    async def __get_relationships(groups: list[list[str]]) -> Relationships:
-        relationships = Relationships()
-        async with CachedSession(cache=SQLiteBackend("bsky_cache")) as session:
-            for requests in __chunked(groups, MAX_REQUESTS_IN_FLIGHT):
-                tasks = [
-                    asyncio.ensure_future(
-                        __call_api_async(
-                            session,
-                            "app.bsky.graph.getRelationships",
-                            {"actor": did, "others": others},
-                        )
-                    )
-                    for others in requests
-                ]
-                results = await asyncio.gather(*tasks)
-                for json in results:
-                    if "relationships" in json:
-                        for rel in json["relationships"]:
-                            if "following" in rel:
-                                relationships.following.append(rel["did"])
-                            if "followedBy" in rel:
-                                relationships.followedBy.append(rel["did"])
-        return relationships
-
-    groups = [chunk for chunk in __chunked(others_dids, GET_RELATIONSHIPS_MAX_OTHERS)]
-    return asyncio.run(__get_relationships(groups))
+
+def get_followers_relationships(
+    dids: list[str],
+    others_dids: list[str] | None = None,
+    errors: dict[str, Exception] | None = None,
+) -> dict[str, Relationships]:
+    return _run(
+        lambda client: client.get_followers_relationships(dids, others_dids, errors)
+    )
+
+
+def iter_followers_relationships(
+    dids: list[str],
+    others_dids: list[str] | None = None,
+    errors: dict[str, Exception] | None = None,
+) -> Iterator[tuple[str, Relationships]]:
+    return _iterate(
+        lambda client: client.iter_followers_relationships(dids, others_dids, errors)
+    )
+
+
+def iter_all_follows(
+    dids: list[str], errors: dict[str, Exception] | None = None
+) -> Iterator[tuple[str, list[str]]]:
+    return _iterate(lambda client: client.iter_all_follows(dids, errors))
+
+
+def get_all_follows(
+    dids: list[str], errors: dict[str, Exception] | None = None
+) -> dict[str, list[str]]:
+    return _run(lambda client: client.get_all_follows(dids, errors))
 
 
 # Command line interface to test bsky operations ##################################################
@@ -300,9 +1176,7 @@ def cmd_get_profile(handle: str):
 @main.command("followers")
 @click.argument("handle")
 def cmd_get_profiles(handle):
-    followers = get_followers(handle)
-    profiles = get_profiles([f.did for f in followers])
-    for p in profiles:
+    for p in iter_followers(handle, detailed=True):
         print(p.did, p.handle, f'"{p.displayName}"', p.followersCount, p.followsCount)
 
 
@@ -312,7 +1186,7 @@ def cmd_get_relationships(handle):
     [root] = get_profiles([handle])
     print(root)
 
-    followers = get_followers(handle)
+    followers = list(iter_followers(handle))
 
     did2profile: dict[str, Profile] = {root.did: root}
     for profile in followers:
@@ -340,17 +1214,43 @@ def cmd_get_feed(handle):
             print(f"🗘  Repost[{f.post.author.handle}]({f.post.uri})")
 
 
+@main.command("cache")
+@click.option(
+    "--compacta", is_flag=True, help="Delete stale and old entries, and compact"
+)
+def cmd_cache(compacta: bool):
+    cache_file = _cache_file(CACHE_NAME)
+    store = CrawlStore(STORE_NAME)
+    try:
+        if compacta:
+            print(f"Evicted {compact_cache()} cached responses")
+            print(f"Deleted {store.compact()} store entries")
+        print(f"HTTP cache: {cache_file} ({_file_size(cache_file) / 1024**2:.1f} MiB)")
+        print(f"Store:      {STORE_NAME} ({_file_size(STORE_NAME) / 1024**2:.1f} MiB)")
+        for kind, count in store.count().items():
+            print(f"  {kind:<14} {count:>10}")
+        stats = store.get_stats()
+        requests = stats["requests"] if "requests" in stats else 0
+        hits = stats["cache_hits"] if "cache_hits" in stats else 0
+        store_hits = stats["store_hits"] if "store_hits" in stats else 0
+        retries = stats["retries"] if "retries" in stats else 0
+        # Every store hit stands for the requests it avoided
+        lookups = requests + store_hits
+        ratio = (hits + store_hits) / lookups if lookups > 0 else 0.0
+        print(
+            f"Requests: {requests}, cache hits: {hits}, store hits: {store_hits}"
+            f" ({ratio:.1%} hit ratio), retries: {retries}"
+        )
+    finally:
+        store.close()
+
+
 @main.command("thread")
 @click.argument("thread_uri")
 def cmd_get_thread(thread_uri):
-    def print_thread(thread: Thread, level: int = 0):
-        handle = thread.post.author.handle
-        text = thread.post.text
-        print(f"{"    " * level}{handle}: {text}")
-        for reply in thread.replies:
-            print_thread(reply, level + 1)
-
-    print_thread(get_thread(thread_uri))
+    thread = get_thread(thread_uri)
+    for post, level in zip(thread.posts, thread.depth()):
+        print(f"{'    ' * level}{post.author.handle}: {post.text}")
 
 
 if __name__ == "__main__":
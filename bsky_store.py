@@ -0,0 +1,368 @@
+import hashlib, json, sqlite3, time
+from typing import Any, Iterable
+
+try:
+    from orjson import loads
+except ImportError:  # orjson is optional, it only makes decoding faster
+    from json import loads
+
+# Constants #######################################################################################
+
+STORE_NAME = "bsky_store.sqlite"
+
+STORE_MAX_BYTES = 1024**3  # Compact the store when it grows over this size
+STORE_COMPACT_RATIO = 0.8  # Compacting leaves the store at this fraction of the maximum
+
+# How long (in seconds) each kind of entity is considered fresh. The HTTP cache
+# keeps the responses of the API call that returns each kind for as long (see
+# TTLS and bsky.CACHE_URLS_EXPIRE_AFTER)
+PROFILE_TTL = 6 * 3600
+FOLLOWERS_TTL = 6 * 3600
+FOLLOWS_TTL = 6 * 3600
+RELATIONSHIP_TTL = 12 * 3600
+POST_TTL = 3600
+THREAD_TTL = 7 * 24 * 3600
+
+# Writes are committed in batches (WAL mode), not after every API response
+COMMIT_INTERVAL = 5.0
+COMMIT_MAX_PENDING = 1000
+
+# Version 1 stored one relationships row per pair of users
+_SCHEMA_VERSION = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS profiles (
+    did TEXT PRIMARY KEY,
+    handle TEXT NOT NULL,
+    json TEXT NOT NULL,
+    detailed INTEGER NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS profiles_handle ON profiles (handle);
+CREATE TABLE IF NOT EXISTS followers (
+    did TEXT PRIMARY KEY,
+    dids TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS follows (
+    did TEXT PRIMARY KEY,
+    dids TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS relationships (
+    actor TEXT PRIMARY KEY,
+    others TEXT NOT NULL,
+    following TEXT NOT NULL,
+    followed_by TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS posts (
+    uri TEXT PRIMARY KEY,
+    json TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS threads (
+    uri TEXT PRIMARY KEY,
+    json TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+TTLS = {
+    "profiles": PROFILE_TTL,
+    "followers": FOLLOWERS_TTL,
+    "follows": FOLLOWS_TTL,
+    "relationships": RELATIONSHIP_TTL,
+    "posts": POST_TTL,
+    "threads": THREAD_TTL,
+}
+
+
+class CrawlStore:
+    r"""A normalized local store of crawled Bluesky entities.
+
+    Profiles are keyed by DID (and indexed by handle), posts and threads by
+    URI, and follow edges by the DID of the user they belong to. So an entity
+    fetched by one API call is reused by any other call that needs it. Every
+    kind of entity has its own freshness policy (the `*_TTL` constants);
+    stale entries are ignored on read and overwritten on write.
+
+    The database runs in WAL mode and writes are committed in batches (every
+    `COMMIT_INTERVAL` seconds or `COMMIT_MAX_PENDING` writes, and on close),
+    so storing a response doesn't block the event loop on a disk sync.
+
+    :param path: The path of the SQLite database
+    """
+
+    def __init__(self, path: str = STORE_NAME):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] < _SCHEMA_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS relationships")
+            self.db.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+        self.db.executescript(_SCHEMA)
+        self.pending_writes = 0
+        self.last_commit = time.monotonic()
+
+    def close(self) -> None:
+        self.commit()
+        self.db.close()
+
+    def commit(self) -> None:
+        """Commit all the pending writes."""
+        self.db.commit()
+        self.pending_writes = 0
+        self.last_commit = time.monotonic()
+
+    def __written(self) -> None:
+        self.pending_writes += 1
+        if (
+            self.pending_writes >= COMMIT_MAX_PENDING
+            or time.monotonic() - self.last_commit >= COMMIT_INTERVAL
+        ):
+            self.commit()
+
+    def delete_expired(self) -> int:
+        """Delete all the stale entries and return how many were deleted."""
+        now = time.time()
+        deleted = 0
+        for table, ttl in TTLS.items():
+            cursor = self.db.execute(
+                f"DELETE FROM {table} WHERE fetched_at < ?", (now - ttl,)
+            )
+            deleted += cursor.rowcount
+        self.commit()
+        return deleted
+
+    def size(self) -> int:
+        """Return the number of bytes used by the entries (free pages not included)."""
+        [pages] = self.db.execute("PRAGMA page_count").fetchone()
+        [free_pages] = self.db.execute("PRAGMA freelist_count").fetchone()
+        [page_size] = self.db.execute("PRAGMA page_size").fetchone()
+        return (pages - free_pages) * page_size
+
+    def compact(self, max_bytes: int = STORE_MAX_BYTES) -> int:
+        """Delete the stale entries and then, while the store doesn't fit in
+        `STORE_COMPACT_RATIO * max_bytes`, the oldest tenth of every kind of
+        entity. Finally reclaim the free space.
+
+        :returns deleted: The number of entries deleted
+        """
+        deleted = self.delete_expired()
+        while self.size() > max_bytes * STORE_COMPACT_RATIO:
+            evicted = 0
+            for table in TTLS:
+                cursor = self.db.execute(
+                    f"""
+                    DELETE FROM {table} WHERE rowid IN (
+                        SELECT rowid FROM {table} ORDER BY fetched_at
+                        LIMIT (SELECT COUNT(*) / 10 + 1 FROM {table})
+                    )
+                    """
+                )
+                evicted += cursor.rowcount
+            self.commit()
+            if evicted == 0:
+                break
+            deleted += evicted
+        self.db.execute("VACUUM")
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return deleted
+
+    def count(self) -> dict[str, int]:
+        """Return the number of entries of every kind."""
+        return {
+            table: self.db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in TTLS
+        }
+
+    # Usage statistics
+
+    def add_stats(self, counts: dict[str, int]) -> None:
+        """Add `counts` to the accumulated usage statistics."""
+        self.db.executemany(
+            """
+            INSERT INTO stats (name, value) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET value = value + excluded.value
+            """,
+            counts.items(),
+        )
+        self.commit()
+
+    def get_stats(self) -> dict[str, int]:
+        return dict(self.db.execute("SELECT name, value FROM stats").fetchall())
+
+    # Profiles
+
+    def put_profiles(self, profiles: Iterable[Any], detailed: bool) -> None:
+        """Store profile JSONs. Basic profile views never replace fresh detailed ones."""
+        now = time.time()
+        min_time = now - PROFILE_TTL
+        self.db.executemany(
+            """
+            INSERT INTO profiles (did, handle, json, detailed, fetched_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (did) DO UPDATE SET
+                handle = excluded.handle,
+                json = excluded.json,
+                detailed = excluded.detailed,
+                fetched_at = excluded.fetched_at
+            WHERE excluded.detailed >= profiles.detailed
+                OR profiles.fetched_at < ?
+            """,
+            [
+                (p["did"], p["handle"], json.dumps(p), int(detailed), now, min_time)
+                for p in profiles
+            ],
+        )
+        self.__written()
+
+    def get_profiles(self, actors: Iterable[str], detailed: bool) -> dict[str, Any]:
+        """Return the fresh profile JSONs of the `actors` (DIDs or handles).
+
+        :returns profiles: A dict mapping each actor found to its profile JSON
+        """
+        result: dict[str, Any] = {}
+        min_time = time.time() - PROFILE_TTL
+        for actor in actors:
+            column = "did" if actor.startswith("did:") else "handle"
+            row = self.db.execute(
+                f"SELECT json FROM profiles WHERE {column} = ? AND fetched_at >= ?"
+                " AND detailed >= ?",
+                (actor, min_time, int(detailed)),
+            ).fetchone()
+            if row is not None:
+                result[actor] = loads(row[0])
+        return result
+
+    def resolve(self, actor: str) -> str | None:
+        """Return the DID of an actor (a DID or a handle), if it is known."""
+        if actor.startswith("did:"):
+            return actor
+        row = self.db.execute(
+            "SELECT did FROM profiles WHERE handle = ?", (actor,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    # Follow edges
+
+    def __put_dids(self, table: str, did: str, dids: list[str]) -> None:
+        self.db.execute(
+            f"INSERT OR REPLACE INTO {table} (did, dids, fetched_at) VALUES (?, ?, ?)",
+            (did, json.dumps(dids), time.time()),
+        )
+        self.__written()
+
+    def __get_dids(self, table: str, did: str, ttl: float) -> list[str] | None:
+        row = self.db.execute(
+            f"SELECT dids FROM {table} WHERE did = ? AND fetched_at >= ?",
+            (did, time.time() - ttl),
+        ).fetchone()
+        return loads(row[0]) if row is not None else None
+
+    def put_followers(self, did: str, follower_dids: list[str]) -> None:
+        self.__put_dids("followers", did, follower_dids)
+
+    def get_followers(self, did: str) -> list[str] | None:
+        """Return the (complete) list of followers of `did`, if fresh."""
+        return self.__get_dids("followers", did, FOLLOWERS_TTL)
+
+    def put_follows(self, did: str, followed_dids: list[str]) -> None:
+        self.__put_dids("follows", did, followed_dids)
+
+    def get_follows(self, did: str) -> list[str] | None:
+        """Return the (complete) list of users followed by `did`, if fresh."""
+        return self.__get_dids("follows", did, FOLLOWS_TTL)
+
+    def put_relationships(
+        self,
+        actor: str,
+        others_key: str,
+        following: list[str],
+        followed_by: list[str],
+    ) -> None:
+        """Store the relationships of `actor` with all the users of a set, as
+        the DIDs among them that it follows and that follow it (one row per
+        actor, replacing the relationships with any other set of users).
+
+        :param others_key: The `others_key` of the set of users (computed once
+            by the caller, since the same set is usually checked by every actor)
+        """
+        self.db.execute(
+            "INSERT OR REPLACE INTO relationships VALUES (?, ?, ?, ?, ?)",
+            (
+                actor,
+                others_key,
+                json.dumps(following),
+                json.dumps(followed_by),
+                time.time(),
+            ),
+        )
+        self.__written()
+
+    def get_relationships(
+        self, actor: str, others_key: str
+    ) -> tuple[list[str], list[str]] | None:
+        """Return the `(following, followed_by)` DIDs among a set of users, if
+        the relationships of `actor` with exactly these users (identified by
+        their `others_key`) are stored and fresh."""
+        row = self.db.execute(
+            """
+            SELECT following, followed_by FROM relationships
+            WHERE actor = ? AND others = ? AND fetched_at >= ?
+            """,
+            (actor, others_key, time.time() - RELATIONSHIP_TTL),
+        ).fetchone()
+        return (loads(row[0]), loads(row[1])) if row is not None else None
+
+    # Posts and threads
+
+    def put_posts(self, posts: Iterable[Any]) -> None:
+        now = time.time()
+        posts = list(posts)
+        self.db.executemany(
+            "INSERT OR REPLACE INTO posts (uri, json, fetched_at) VALUES (?, ?, ?)",
+            [(p["uri"], json.dumps(p), now) for p in posts],
+        )
+        self.__written()
+        self.put_profiles((p["author"] for p in posts), detailed=False)
+
+    def get_post(self, uri: str) -> Any | None:
+        row = self.db.execute(
+            "SELECT json FROM posts WHERE uri = ? AND fetched_at >= ?",
+            (uri, time.time() - POST_TTL),
+        ).fetchone()
+        return loads(row[0]) if row is not None else None
+
+    def put_thread(self, uri: str, thread: Any) -> None:
+        self.db.execute(
+            "INSERT OR REPLACE INTO threads (uri, json, fetched_at) VALUES (?, ?, ?)",
+            (uri, json.dumps(thread), time.time()),
+        )
+        self.__written()
+        posts = []
+        pending = [thread]
+        while pending:
+            t = pending.pop()
+            if "post" in t:
+                posts.append(t["post"])
+            pending += t["replies"] if "replies" in t else []
+        self.put_posts(posts)
+
+    def get_thread(self, uri: str) -> Any | None:
+        row = self.db.execute(
+            "SELECT json FROM threads WHERE uri = ? AND fetched_at >= ?",
+            (uri, time.time() - THREAD_TTL),
+        ).fetchone()
+        return loads(row[0]) if row is not None else None
+
+
+def others_key(others: Iterable[str]) -> str:
+    """A short key that identifies a set of DIDs (regardless of their order)."""
+    return hashlib.sha1("\n".join(sorted(set(others))).encode()).hexdigest()
@@ -0,0 +1,49 @@
+from graph_tool.all import Graph
+from typing import Optional
+import hashlib
+import numpy as np
+import os
+
+
+def hash_estructural(g: Graph) -> str:
+    """
+    Retorna un hash de l'estructura del graf (nombre de vèrtexs i llista d'arestes), independent de les propietats.
+    Dos grafs amb el mateix hash tenen els mateixos vèrtexs i arestes, en el mateix ordre.
+    """
+    h = hashlib.sha1()
+    h.update(np.int64(g.num_vertices()).tobytes())
+    h.update(np.ascontiguousarray(g.get_edges(), dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+def fitxer_cache(fitxer_gt: str, nom: str) -> str:
+    """
+    Retorna el camí d'un fitxer de memòria cau associat a un graf, al costat del .gt (ex: <handle>_followers.layout.npz).
+    """
+    return f"{os.path.splitext(fitxer_gt)[0]}.{nom}.npz"
+
+
+def carrega_cache(fitxer: str, clau: Optional[str] = None) -> Optional[dict]:
+    """
+    Retorna els arrays desats a la memòria cau si existeix i es va desar amb la mateixa clau (si no, None).
+    Sense clau, retorna el que hi hagi desat encara que correspongui a una altra versió del graf.
+    """
+    if not os.path.isfile(fitxer):
+        return None
+    try:
+        with np.load(fitxer) as dades:
+            if clau is not None and str(dades["clau"]) != clau:
+                return None
+            return {k: dades[k] for k in dades.files if k != "clau"}
+    except (OSError, ValueError, KeyError) as e:
+        print(f"No s'ha pogut llegir la memòria cau {fitxer}: {e}")
+        return None
+
+
+def desa_cache(fitxer: str, clau: str, **arrays: np.ndarray) -> None:
+    """
+    Desa els arrays a la memòria cau amb la clau indicada (substitueix el que hi hagués).
+    """
+    temporal = fitxer + ".tmp.npz"
+    np.savez(temporal, clau=np.array(clau), **arrays)
+    os.replace(temporal, fitxer)
@@ -1,16 +1,244 @@
 from graph_tool.all import *
 import matplotlib.pyplot as plt
-from collections import defaultdict
 from graph_tool.topology import label_components, label_largest_component
 import os
 import sys
 import matplotlib.cm as cm
+from dibuix import dibuixa_graf
+from cache_grafs import carrega_cache, desa_cache, fitxer_cache, hash_estructural
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
 
+# Escombrades MCMC (merge-split) per refinar cada partició: la d'una execució anterior quan el graf ha canviat, o la de cada inici.
+# Per defecte cap: minimize_nested_blockmodel_dl ja dona una partició ajustada, i les escombrades són opcionals
+NUM_ESCOMBRADES = 0
+# Inferències SBM independents (inicis) que es fan des de zero; es queda la de menor longitud de descripció.
+# Per defecte una sola: fer-ne més (en paral·lel) és opcional i només val la pena si es vol una partició més estable
+NUM_INICIS = 1
 
-def main(handle=None):
+
+def _blocs_inicials(g, dids_previs, blocs_previs):
+    """
+    Trasllada els blocs d'una partició anterior als vèrtexs actuals del graf, fent servir el DID de cada vèrtex.
+    Els vèrtexs nous van al bloc més freqüent dels seus veïns ja assignats o, si no en tenen, a un bloc nou.
+    """
+    index = dict(zip(dids_previs, blocs_previs))
+    vprop_did = g.vertex_properties["did"]
+    blocs = np.array([index.get(vprop_did[v], -1) for v in g.vertices()], dtype=np.int64)
+    nou = int(blocs_previs.max()) + 1 if len(blocs_previs) else 0
+    for v in np.flatnonzero(blocs < 0):
+        veins = blocs[g.get_all_neighbors(v)]
+        veins = veins[veins >= 0]
+        if len(veins):
+            blocs[v] = np.bincount(veins).argmax()
+        else:
+            blocs[v] = nou
+            nou += 1
+    return blocs
+
+
+def _esten_jerarquia(b0, bs_previs):
+    """
+    Completa la jerarquia anterior perquè cobreixi els blocs nous del nivell inferior b0: cada bloc nou penja d'un grup nou al nivell superior (o de l'arrel, a l'últim nivell).
+    """
+    bs = [b0] + [np.array(b, dtype=np.int64) for b in bs_previs[1:]]
+    for l in range(1, len(bs)):
+        falten = int(bs[l - 1].max()) + 1 - len(bs[l])
+        if falten > 0:
+            grup = int(bs[l].max()) + 1 if l + 1 < len(bs) else 0
+            bs[l] = np.concatenate((bs[l], np.full(falten, grup, dtype=np.int64)))
+    return _compacta(bs)
+
+
+def _compacta(bs):
+    """
+    Reetiqueta cada nivell de la jerarquia amb etiquetes consecutives (0..B-1), ajustant el nivell superior.
+    """
+    bs = [np.asarray(b) for b in bs]
+    for l in range(len(bs)):
+        usats, bs[l] = np.unique(bs[l], return_inverse=True)
+        if l + 1 < len(bs):
+            bs[l + 1] = bs[l + 1][usats]
+    return bs
+
+
+def _inicialitza_treballador():
+    """
+    Prepara un procés treballador dels inicis SBM: cada inici fa servir un sol fil OpenMP per no competir amb els altres.
+    """
+    openmp_set_num_threads(1)
+
+
+def _inici_sbm(graf_path, llavor, escombrades):
+    """
+    Fa una inferència SBM jeràrquica independent (un inici) sobre el graf desat i retorna (entropia, nivells).
+    S'executa en un procés treballador (vegeu _multi_inici_sbm), de manera que la llavor només afecta aquest procés.
+    """
+    seed_rng(llavor)
+    np.random.seed(llavor)
+    state = minimize_nested_blockmodel_dl(load_graph(graf_path))
+    if escombrades > 0:
+        state.multiflip_mcmc_sweep(niter=escombrades, beta=np.inf)
+    return state.entropy(), [np.asarray(b) for b in state.get_bs()]
+
+
+def _multi_inici_sbm(g, graf_path, inicis, processos, escombrades):
+    """
+    Fa inicis inferències SBM independents i retorna l'estat de menor longitud de descripció.
+    Amb un sol inici, la inferència es fa directament sobre g, al procés principal i amb tots els fils OpenMP.
+    Amb més d'un, es fan en paral·lel en processos treballadors (per defecte un per nucli) i es mostra la dispersió de les longituds de descripció i del nombre de comunitats entre inicis.
+    """
+    if inicis == 1:
+        state = minimize_nested_blockmodel_dl(g)
+        if escombrades > 0:
+            state.multiflip_mcmc_sweep(niter=escombrades, beta=np.inf)
+        return state
+    llavors = [int(x) for x in np.random.SeedSequence().generate_state(inicis)]
+    with ProcessPoolExecutor(
+        max_workers=processos, initializer=_inicialitza_treballador
+    ) as executor:
+        resultats = list(
+            executor.map(
+                _inici_sbm, [graf_path] * inicis, llavors, [escombrades] * inicis
+            )
+        )
+    entropies = np.array([s for s, _ in resultats])
+    num_blocs = [len(np.unique(bs[0])) for _, bs in resultats]
+    millor = int(entropies.argmin())
+    print(
+        f"SBM amb {inicis} inicis: longitud de descripció mínima {entropies.min():.1f}, "
+        f"màxima {entropies.max():.1f}, mitjana {entropies.mean():.1f} (desv. {entropies.std():.1f}); "
+        f"comunitats entre {min(num_blocs)} i {max(num_blocs)}. Es queda l'inici {millor}."
+    )
+    return NestedBlockState(g, bs=resultats[millor][1])
+
+
+def detecta_comunitats(
+    g,
+    graf_path,
+    inicis=NUM_INICIS,
+    processos=None,
+    escombrades=NUM_ESCOMBRADES,
+):
+    """
+    Detecta les comunitats del graf amb una sola inferència SBM jeràrquica (nested). Retorna (blocks, nested_state), on blocks és el nivell inferior de la jerarquia (les comunitats).
+    La inferència es fa amb inicis inicis independents (per defecte un; si n'hi ha més, en paral·lel, vegeu _multi_inici_sbm), cadascun refinat amb escombrades escombrades MCMC (per defecte cap).
+    Els resultats es desen en una memòria cau al costat del .gt, indexada pel hash estructural del graf i juntament amb els inicis i les escombrades que els han produït:
+    si el graf no ha canviat i la partició desada es va obtenir amb almenys tants inicis i escombrades com es demanen, es reutilitza tal qual.
+    Si no, la partició anterior (traslladada pel DID de cada vèrtex si el graf ha canviat) es refina i compta com un dels inicis: la resta es fan des de zero i es queda la de menor longitud de descripció.
+    """
+    fitxer = fitxer_cache(graf_path, "sbm")
+    clau = hash_estructural(g)
+    cache = carrega_cache(fitxer, clau)
+    if cache is not None:
+        # Les memòries cau anteriors a aquests camps es van desar sense indicar-los
+        inicis_desats = int(cache["inicis"]) if "inicis" in cache else 1
+        escombrades_desades = int(cache["escombrades"]) if "escombrades" in cache else 0
+        if inicis_desats >= inicis and escombrades_desades >= escombrades:
+            print(
+                f"El graf no ha canviat: es reutilitzen les comunitats desades ({inicis_desats} inicis, {escombrades_desades} escombrades)."
+            )
+            nested_state = NestedBlockState(
+                g, bs=[cache[f"nivell_{l}"] for l in range(int(cache["nivells"]))]
+            )
+            return nested_state.levels[0].get_blocks(), nested_state
+        print(
+            f"Les comunitats desades es van obtenir amb {inicis_desats} inicis i {escombrades_desades} escombrades: "
+            f"es tornen a inferir amb {inicis} inicis i {escombrades} escombrades."
+        )
+
+    previ = cache if cache is not None else carrega_cache(fitxer)
+    estats = []
+    if previ is not None and "did" in g.vertex_properties:
+        if cache is None:
+            print("El graf ha canviat: es refinen les comunitats de l'execució anterior.")
+        nivells = [previ[f"nivell_{l}"] for l in range(int(previ["nivells"]))]
+        bs = _esten_jerarquia(
+            _blocs_inicials(g, previ["dids"], nivells[0]), nivells
+        )
+        estat = minimize_nested_blockmodel_dl(g, init_bs=bs)
+        if escombrades > 0:
+            estat.multiflip_mcmc_sweep(niter=escombrades, beta=np.inf)
+        estats.append(estat)
+    if inicis > len(estats):
+        estats.append(
+            _multi_inici_sbm(g, graf_path, inicis - len(estats), processos, escombrades)
+        )
+    nested_state = min(estats, key=lambda estat: estat.entropy())
+
+    vprop_did = g.vertex_properties["did"] if "did" in g.vertex_properties else None
+    bs = nested_state.get_bs()
+    desa_cache(
+        fitxer,
+        clau,
+        dids=np.array([vprop_did[v] if vprop_did is not None else "" for v in g.vertices()]),
+        nivells=np.array(len(bs)),
+        inicis=np.array(inicis),
+        escombrades=np.array(escombrades),
+        **{f"nivell_{l}": np.asarray(b) for l, b in enumerate(bs)},
+    )
+    return nested_state.levels[0].get_blocks(), nested_state
+
+
+def estadistiques_comunitats(g, blocks):
+    """
+    Calcula, per a cada comunitat, el nombre de nodes, el d'arestes internes i la densitat, amb operacions vectorials sobre g.get_edges() i blocks.a.
+    Retorna una taula (DataFrame) amb una fila per comunitat.
+    """
+    comunitats, blocs, nodes = np.unique(
+        blocks.a, return_inverse=True, return_counts=True
+    )
+    arestes = g.get_edges()
+    origen, desti = blocs[arestes[:, 0]], blocs[arestes[:, 1]]
+    internes = np.bincount(origen[origen == desti], minlength=len(comunitats))
+    parelles = nodes * (nodes - 1)
+    densitat = np.divide(
+        2 * internes, parelles, out=np.zeros(len(comunitats)), where=parelles > 0
+    )
+    return pd.DataFrame(
+        {
+            "comunitat": comunitats,
+            "nodes": nodes,
+            "arestes_internes": internes,
+            "densitat": densitat,
+        }
+    )
+
+
+def pagerank_comunitats(g, blocks):
+    """
+    Calcula el PageRank de cada node dins la seva comunitat (com a graf no dirigit), per a totes les comunitats.
+    Cada comunitat és una GraphView del graf original amb una màscara de vèrtexs, sense copiar-lo. Les comunitats sense arestes internes queden sense valor.
+    Retorna una taula (DataFrame) amb una fila per node.
+    """
+    b = blocks.a
+    valors = np.full(g.num_vertices(), np.nan)
+    for cid in np.unique(b):
+        mascara = b == cid
+        subgraf = GraphView(g, vfilt=mascara, directed=False)
+        if subgraf.num_edges() > 0:
+            valors[mascara] = pagerank(subgraf).a[mascara]
+    taula = pd.DataFrame(
+        {"node_id": np.arange(g.num_vertices()), "comunitat": b, "pagerank": valors}
+    )
+    if "handle" in g.vertex_properties:
+        vprop_handle = g.vertex_properties["handle"]
+        taula.insert(1, "handle", [vprop_handle[v] for v in g.vertices()])
+    return taula
+
+
+def main(
+    handle=None,
+    inicis=NUM_INICIS,
+    processos=None,
+    escombrades=NUM_ESCOMBRADES,
+    dibuixa=True,
+):
     """
     Analitza la comunitat de seguidors d'un usuari: carrega el graf, detecta components, calcula comunitats amb SBM, visualitza-les, calcula densitats i centralitats, i exporta resultats.
     Si el graf no existeix, l'intenta generar automàticament. Desa SVG, PDF i CSV a la carpeta de resultats.
+    Els paràmetres inicis, processos i escombrades controlen la inferència SBM (vegeu detecta_comunitats). Amb dibuixa=False no es generen les imatges (SVG de comunitats i PDF de la jerarquia), només els CSV.
     """
     # ---------------------------
     # 1. Càrrega del graf
@@ -67,129 +295,91 @@ def main(handle=None):
     # ---------------------------
     # 2. Detecció de comunitats (SBM)
     # ---------------------------
-    state = minimize_blockmodel_dl(g)
-    blocks = state.get_blocks()
+    blocks, nested_state = detecta_comunitats(
+        g, graf_path, inicis, processos, escombrades
+    )
     print(f"Nombre de comunitats trobades per SBM: {len(set(blocks.a))}")
 
     # ---------------------------
     # 3. Visualització amb colors per comunitat
     # ---------------------------
-    block_colors = g.new_vertex_property("vector<float>")
-    edge_colors = g.new_edge_property("vector<float>")
-    palette = cm.get_cmap("tab20")
-
-    for v in g.vertices():
-        c = blocks[v]
-        color = palette(c % 20)
-        block_colors[v] = color[:3]
-
-    for e in g.edges():
-        src = int(blocks[e.source()])
-        tgt = int(blocks[e.target()])
-        # Si l'aresta connecta nodes de la mateixa comunitat, pinta-la del color de la comunitat
-        if src == tgt:
-            edge_colors[e] = palette(src % 20)[:3]
-        else:
-            edge_colors[e] = (0.7, 0.7, 0.7)  # gris per arestes entre comunitats
+    if dibuixa:
+        block_colors = g.new_vertex_property("vector<float>")
+        edge_colors = g.new_edge_property("vector<float>")
+        palette = cm.get_cmap("tab20")
+        # Taula de colors: un color per bloc (mòdul 20), calculat una sola vegada
+        colors = np.asarray(palette(np.arange(20)))[:, :3]
+        b = blocks.a % 20
+        block_colors.set_2d_array(colors[b].T)
 
-    # Ajusta la mida dels nodes segons el nombre de nodes
-    n_nodes = g.num_vertices()
-    if n_nodes < 50:
-        vsize = 20
-    elif n_nodes < 200:
-        vsize = 12
-    else:
-        vsize = 6
-
-    # Desa com svg i PDF només a la carpeta de resultats
-    output_svg = os.path.join(carpeta, f"comunitats_{handle}.svg")
-    graph_draw(
-        g,
-        vertex_fill_color=block_colors,
-        edge_color=edge_colors,
-        vertex_shape="circle",
-        vertex_size=vsize,
-        edge_pen_width=1.2,
-        output_size=(1800, 1800),
-        bg_color="white",
-        output=output_svg,
-    )
-    print(f"Imatge svg de comunitats desada a: {output_svg}")
-
-    # ---------------------------
-    # 4. Càlcul de densitat per comunitat
-    # ---------------------------
-    def calcular_densitat_comunitats(g, blocs):
-        comunitats = defaultdict(set)
-        arestes = defaultdict(int)
+        # Les arestes dins d'una comunitat es pinten del color de la comunitat, i les que en connecten dues de gris.
+        # Els arrays de propietats d'aresta s'indexen per índex d'aresta (que pot tenir forats), no per l'ordre de get_edges:
+        # cada color es col·loca a la posició que indica la tercera columna, l'índex de l'aresta
+        arestes = g.get_edges([g.edge_index])
+        src, tgt = blocks.a[arestes[:, 0]], blocks.a[arestes[:, 1]]
+        color_arestes = np.full((g.edge_index_range, 3), 0.7)
+        color_arestes[arestes[:, 2]] = np.where(
+            (src == tgt)[:, None], colors[b[arestes[:, 0]]], 0.7
+        )
+        edge_colors.set_2d_array(color_arestes.T)
 
-        for v in g.vertices():
-            comunitats[int(blocs[v])].add(v)
-
-        for e in g.edges():
-            src = int(blocs[e.source()])
-            tgt = int(blocs[e.target()])
-            if src == tgt:
-                arestes[src] += 1
-
-        for cid, nodes in comunitats.items():
-            n = len(nodes)
-            e = arestes[cid]
-            densitat = (2 * e) / (n * (n - 1)) if n > 1 else 0
-            print(
-                f"Comunitat {cid}: {n} nodes, {e} arestes internes, densitat = {densitat:.3f}"
-            )
+        # Ajusta la mida dels nodes segons el nombre de nodes
+        n_nodes = g.num_vertices()
+        if n_nodes < 50:
+            vsize = 20
+        elif n_nodes < 200:
+            vsize = 12
+        else:
+            vsize = 6
 
-    calcular_densitat_comunitats(g, blocks)
+        # Desa com svg només a la carpeta de resultats, amb la mateixa disposició que el graf de seguidors
+        output_svg = os.path.join(carpeta, f"comunitats_{handle}.svg")
+        dibuixa_graf(
+            g,
+            output_svg,
+            graf_path,
+            vertex_fill_color=block_colors,
+            edge_color=edge_colors,
+            vertex_size=vsize,
+            output_size=(1800, 1800),
+        )
 
     # ---------------------------
-    # 5. Centralitat (PageRank) dins d'una comunitat
+    # 4. Estadístiques i PageRank de totes les comunitats
     # ---------------------------
-    def pagerank_per_comunitat(g, blocks, comunitat_id=None):
-        from graph_tool.centrality import pagerank
-
-        if comunitat_id is not None:
-            comunitats = [comunitat_id]
-        else:
-            comunitats = set(blocks.a)
-
-        for cid in comunitats:
-            filt = g.new_vertex_property("bool")
-            for v in g.vertices():
-                filt[v] = blocks[v] == cid
-            g.set_vertex_filter(filt)
-            subgraph = Graph(g, vorder=g.vertex_index, directed=False)
-
-            num_nodes = subgraph.num_vertices()
-            num_edges = subgraph.num_edges()
-
-            print(
-                f"Comunitat {cid}: {num_nodes} nodes, {num_edges} arestes internes",
-                end="",
-            )
-
-            if num_nodes > 0 and num_edges > 0:
-                pr = pagerank(subgraph)
-                densitat = 2 * num_edges / (num_nodes * (num_nodes - 1))
-                print(f", densitat = {densitat:.3f}")
-                # Si vols mostrar els PageRanks:
-                for v in subgraph.vertices():
-                    print(f" - node {int(v)}: PR = {pr[v]:.4f}")
-            else:
-                print(
-                    ", comunitat buida o sense connexions — s'omet càlcul de PageRank."
-                )
-
-            g.clear_filters()
-
-    # Exemple amb comunitat 0
-    pagerank_per_comunitat(g, blocks, comunitat_id=0)
+    estadistiques = estadistiques_comunitats(g, blocks)
+    pr_comunitats = pagerank_comunitats(g, blocks)
+    # Node amb més PageRank de cada comunitat
+    maxims = (
+        pr_comunitats.dropna(subset=["pagerank"])
+        .sort_values("pagerank", ascending=False)
+        .drop_duplicates("comunitat")
+        .rename(columns={"node_id": "node_pagerank_max", "pagerank": "pagerank_max"})
+    )
+    estadistiques = estadistiques.merge(
+        maxims[["comunitat", "node_pagerank_max", "pagerank_max"]],
+        on="comunitat",
+        how="left",
+    )
+    output_estadistiques = os.path.join(carpeta, "comunitats_estadistiques.csv")
+    estadistiques.to_csv(output_estadistiques, index=False)
+    output_pagerank = os.path.join(carpeta, "comunitats_pagerank.csv")
+    pr_comunitats.to_csv(output_pagerank, index=False)
+    print(
+        estadistiques.sort_values("nodes", ascending=False)
+        .head(20)
+        .to_string(index=False)
+    )
+    print(f"Estadístiques de les comunitats desades a: {output_estadistiques}")
+    print(f"PageRank dins de cada comunitat desat a: {output_pagerank}")
 
     # ---------------------------
-    # 6. Detecció jeràrquica de comunitats (Nested SBM)
+    # 6. Jerarquia de comunitats (Nested SBM, la mateixa inferència que dona les comunitats)
     # ---------------------------
-    nested_state = minimize_nested_blockmodel_dl(g)
-    draw_hierarchy(nested_state, output="jerarquia_comunitats.pdf")
+    if dibuixa:
+        output_jerarquia = os.path.join(carpeta, f"jerarquia_comunitats_{handle}.pdf")
+        draw_hierarchy(nested_state, output=output_jerarquia)
+        print(f"Jerarquia de comunitats desada a: {output_jerarquia}")
 
     # ---------------------------
     # 7. Exportació de les comunitats a CSV
@@ -0,0 +1,100 @@
+from graph_tool.all import Graph, GraphView, graph_draw, load_graph, sfdp_layout
+from cache_grafs import carrega_cache, desa_cache, fitxer_cache, hash_estructural
+from typing import Optional
+import numpy as np
+import os
+
+# Per sobre d'aquest nombre de vèrtexs només es dibuixen els vèrtexs de més grau
+MAX_VERTEXS_DIBUIX = 5000
+MIDA_DIBUIX = (1200, 1200)
+
+
+def _vista_dibuix(g: Graph, max_vertexs: int) -> Graph:
+    """
+    Retorna el graf sencer o, si té més de max_vertexs vèrtexs, una vista amb només els max_vertexs vèrtexs de més grau total.
+    """
+    if g.num_vertices() <= max_vertexs:
+        return g
+    graus = g.degree_property_map("total").a
+    filtre = g.new_vertex_property("bool")
+    filtre.a[np.argsort(-graus, kind="stable")[:max_vertexs]] = True
+    return GraphView(g, vfilt=filtre)
+
+
+def posicions(
+    g: Graph, fitxer_gt: Optional[str] = None, max_vertexs: int = MAX_VERTEXS_DIBUIX
+):
+    """
+    Retorna la disposició dels vèrtexs del graf (propietat de vèrtex 'pos'), calculada amb sfdp_layout només sobre la vista que es dibuixa.
+    Si s'indica fitxer_gt, la disposició es desa en una memòria cau al costat del .gt, indexada pel hash estructural del graf: tots els dibuixos d'una mateixa versió del graf (seguidors, comunitats...) la reutilitzen i queden alineats.
+    """
+    vista = _vista_dibuix(g, max_vertexs)
+    clau = f"{hash_estructural(g)}-{vista.num_vertices()}"
+    fitxer = fitxer_cache(fitxer_gt, "layout") if fitxer_gt is not None else None
+    cache = carrega_cache(fitxer, clau) if fitxer is not None else None
+    if cache is not None:
+        pos = g.new_vertex_property("vector<double>")
+        pos.set_2d_array(cache["pos"].T)
+    else:
+        pos = g.own_property(sfdp_layout(vista))
+        if fitxer is not None:
+            desa_cache(fitxer, clau, pos=pos.get_2d_array([0, 1]).T)
+    g.vertex_properties["pos"] = pos
+    return pos
+
+
+def dibuixa_graf(
+    g: Graph,
+    output_svg: str,
+    fitxer_gt: Optional[str] = None,
+    max_vertexs: int = MAX_VERTEXS_DIBUIX,
+    **opcions,
+) -> bool:
+    """
+    Dibuixa el graf en format SVG fent servir la disposició de la memòria cau (vegeu posicions).
+    Si el graf té més de max_vertexs vèrtexs, només es dibuixen els de més grau. Les opcions addicionals es passen a graph_draw.
+    Retorna si s'ha pogut generar la imatge.
+    """
+    if g.num_vertices() == 0:
+        print("El graf és buit, no es dibuixa.")
+        return False
+    if g.num_vertices() > max_vertexs:
+        print(
+            f"El graf té {g.num_vertices()} nodes: només es dibuixen els {max_vertexs} de més grau."
+        )
+    try:
+        pos = posicions(g, fitxer_gt, max_vertexs)
+        arguments = dict(
+            vertex_shape="circle",
+            vertex_size=8,
+            edge_pen_width=1.2,
+            output_size=MIDA_DIBUIX,
+            bg_color="white",
+        )
+        arguments.update(opcions)
+        graph_draw(_vista_dibuix(g, max_vertexs), pos=pos, output=output_svg, **arguments)
+        print(f"Imatge SVG del graf desada a: {output_svg}")
+        return True
+    except Exception as e:
+        print(f"No s'ha pogut generar l'SVG: {e}")
+        return False
+
+
+def dibuixa_seguidors(client_handle: str) -> bool:
+    """
+    Dibuixa el graf de seguidors desat d'un usuari a resultats/<handle>/seguidors_<handle>.svg.
+    """
+    carpeta = os.path.join("resultats", client_handle)
+    fitxer_gt = os.path.join(carpeta, f"{client_handle}_followers.gt")
+    output_svg = os.path.join(carpeta, f"seguidors_{client_handle}.svg")
+    return dibuixa_graf(load_graph(fitxer_gt), output_svg, fitxer_gt)
+
+
+def dibuixa_threads(client_handle: str) -> bool:
+    """
+    Dibuixa el graf d'interacció de threads desat d'un usuari a resultats/<handle>/threads_<handle>.svg.
+    """
+    carpeta = os.path.join("resultats", client_handle)
+    fitxer_gt = os.path.join(carpeta, f"{client_handle}_threads.gt")
+    output_svg = os.path.join(carpeta, f"threads_{client_handle}.svg")
+    return dibuixa_graf(load_graph(fitxer_gt), output_svg, fitxer_gt)
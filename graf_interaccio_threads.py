@@ -1,33 +1,49 @@
-from bsky import get_feed, get_thread, Thread, Post
-from graph_tool.all import Graph, graph_draw
+from bsky import iter_author_threads, Thread
+from graph_tool.all import Graph
+from dibuix import dibuixa_threads
+from punt_control import PuntControl
+from datetime import datetime
 from typing import Optional, List, Union
+import numpy as np
 import os
 
 
 def _count_replies(thread: Thread) -> int:
     """
-    Calcula el nombre total de respostes dins d'un thread, incloent-hi totes les respostes recursives a qualsevol nivell.
+    Calcula el nombre total de respostes dins d'un thread, incloent-hi totes les respostes a qualsevol nivell.
     Rep un objecte Thread i retorna un enter amb el recompte de respostes totals.
     """
-    return sum(1 + _count_replies(r) for r in thread.replies)
+    return thread.num_replies()
 
 
-def _get_client_threads(client_handle: str, limit: int = 500) -> List[Thread]:
+def _get_client_threads(
+    client_handle: str, limit: int = 500, since: Optional[datetime] = None
+) -> List[Thread]:
     """
-    Recupera tots els threads originals publicats per un usuari concret a Bluesky, sense incloure reposts.
-    El paràmetre 'limit' permet controlar quants posts es consulten com a màxim.
-    Retorna una llista de threads trobats. Si hi ha errors en obtenir algun thread, es mostren per pantalla però el procés continua.
+    Recupera tots els threads originals publicats per un usuari concret a Bluesky, sense incloure reposts ni respostes.
+    El paràmetre 'limit' permet controlar quants posts es consulten com a màxim, i 'since' atura la consulta als posts anteriors a aquesta data.
+    Els threads es demanen concurrentment, mentre encara es carreguen les pàgines següents del feed, i es retornen en ordre d'arribada. Si hi ha errors en obtenir algun thread, es recullen i se'n mostra un resum, però el procés continua.
+    Cada thread obtingut es desa en un punt de control a la carpeta de resultats: si el procés s'interromp, la següent execució no el torna a demanar.
     """
-    threads: List[Thread] = []
-    posts = get_feed(client_handle, limit=limit)
-    for item in posts:
-        if isinstance(item, Post) and item.author.handle == client_handle:
-            post_uri = item.uri
-            try:
-                thread = get_thread(post_uri)
-                threads.append(thread)
-            except Exception as e:
-                print(f"Error amb {post_uri}: {e}")
+    carpeta = os.path.join("resultats", client_handle)
+    os.makedirs(carpeta, exist_ok=True)
+    punt = PuntControl(os.path.join(carpeta, f"{client_handle}_threads.gt.checkpoint"))
+    fets = punt.carrega()
+    if fets:
+        print(f"Es reprèn el rastreig: {len(fets)} threads ja obtinguts.")
+    errors = 0
+    for uri, thread in iter_author_threads(
+        client_handle, limit=limit, since=since, skip=set(fets)
+    ):
+        if isinstance(thread, Exception):
+            errors += 1
+            continue
+        punt.desa(uri, thread)
+        fets[uri] = thread
+    if errors:
+        print(f"No s'han pogut obtenir {errors} de {len(fets) + errors} threads.")
+    threads = [Thread.fromJson(t) for t in fets.values()]
+    punt.esborra()
     return threads
 
 
@@ -35,37 +51,57 @@ def build_interaction_graph(threads: List[Thread], client_handle: str) -> Graph:
     """
     Genera un graf d'interacció a partir de tots els threads originals d'un usuari, fusionant-los en una sola estructura.
     Cada node representa un usuari i cada aresta indica una resposta entre usuaris dins dels threads. El pes de l'aresta reflecteix el nombre d'interaccions.
-    El graf es desa automàticament en format .gt i SVG a la carpeta de resultats de l'usuari. Retorna el graf creat.
+    Les parelles (autor respost, autor de la resposta) de tots els threads s'agreguen amb NumPy i el graf es crea amb una sola crida a add_edge_list.
+    El graf es desa automàticament en format .gt a la carpeta de resultats de l'usuari (el dibuix és una etapa a part, vegeu dibuix.py). Retorna el graf creat.
     """
     graph = Graph(directed=True)
-    user_prop = graph.new_vertex_property("string")
     weight_prop = graph.new_edge_property("int")
-    user_to_vertex = {}
 
-    def _get_vertex(handle: str):
-        if handle not in user_to_vertex:
-            v = graph.add_vertex()
-            user_prop[v] = handle
-            user_to_vertex[handle] = v
-        return user_to_vertex[handle]
+    # Autor de cada post de tots els threads (en preordre) i parelles (post respost, resposta)
+    autors_posts = []
+    respostes_origen = []
+    respostes_desti = []
+    desplacament = 0
+    for t in threads:
+        handles = np.array([a.handle for a in t.authors], dtype=object)
+        autors_posts.append(handles[t.author])
+        respostes_origen.append(t.parent[1:].astype(np.int64) + desplacament)
+        respostes_desti.append(np.arange(1, len(t), dtype=np.int64) + desplacament)
+        desplacament += len(t)
 
-    def _explore_thread_and_add_edges(t: Thread) -> None:
-        post_author_v = _get_vertex(t.post.author.handle)
-        for reply in t.replies:
-            reply_author_v = _get_vertex(reply.post.author.handle)
-            if post_author_v == reply_author_v:
-                _explore_thread_and_add_edges(reply)
-                continue
-            edge = graph.edge(post_author_v, reply_author_v)
-            if edge is None:
-                edge = graph.add_edge(post_author_v, reply_author_v)
-                weight_prop[edge] = 1
-            else:
-                weight_prop[edge] += 1
-            _explore_thread_and_add_edges(reply)
+    if desplacament > 0:
+        autors = np.concatenate(autors_posts)
+        # Els vèrtexs es numeren per ordre de primera aparició de cada usuari
+        usuaris, primer, inversa = np.unique(
+            autors, return_index=True, return_inverse=True
+        )
+        ordre = np.argsort(primer, kind="stable")
+        rang = np.empty_like(ordre)
+        rang[ordre] = np.arange(len(ordre))
+        vertex_post = rang[inversa.reshape(-1)]
 
-    for thread in threads:
-        _explore_thread_and_add_edges(thread)
+        origen = vertex_post[np.concatenate(respostes_origen)]
+        desti = vertex_post[np.concatenate(respostes_desti)]
+        no_propies = origen != desti  # Les respostes a un mateix no compten
+        claus = origen[no_propies] * len(usuaris) + desti[no_propies]
+        claus_uniques, primera, pesos = np.unique(
+            claus, return_index=True, return_counts=True
+        )
+        # Les arestes es creen per ordre de primera aparició de cada parella
+        ordre_arestes = np.argsort(primera, kind="stable")
+        claus_uniques = claus_uniques[ordre_arestes]
+        arestes = np.column_stack(
+            (
+                claus_uniques // len(usuaris),
+                claus_uniques % len(usuaris),
+                pesos[ordre_arestes],
+            )
+        )
+        graph.add_vertex(len(usuaris))
+        graph.add_edge_list(arestes, eprops=[weight_prop])
+        user_prop = graph.new_vertex_property("string", vals=list(usuaris[ordre]))
+    else:
+        user_prop = graph.new_vertex_property("string")
 
     graph.vertex_properties["user"] = user_prop
     graph.edge_properties["weight"] = weight_prop
@@ -76,20 +112,6 @@ def build_interaction_graph(threads: List[Thread], client_handle: str) -> Graph:
     output_gt = os.path.join(carpeta, f"{client_handle}_threads.gt")
     graph.save(output_gt)
     print(f"Graf d'interacció de threads guardat a: {output_gt}")
-    try:
-        output_svg = os.path.join(carpeta, f"threads_{client_handle}.svg")
-        graph_draw(
-            graph,
-            vertex_shape="circle",
-            vertex_size=8,
-            edge_pen_width=1.2,
-            output_size=(1200, 1200),
-            bg_color="white",
-            output=output_svg,
-        )
-        print(f"Imatge SVG del graf desada a: {output_svg}")
-    except Exception as e:
-        print(f"No s'ha pogut generar l'SVG: {e}")
     return graph
 
 
@@ -107,6 +129,7 @@ def main():
         ).strip()
     threads = _get_client_threads(client_handle)
     build_interaction_graph(threads, client_handle)
+    dibuixa_threads(client_handle)
 
 
 if __name__ == "__main__":
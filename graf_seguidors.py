@@ -1,58 +1,205 @@
-from bsky import get_followers, get_relationships, Profile, Relationships
-from graph_tool.all import Graph, graph_draw
+from bsky import (
+    iter_followers,
+    iter_followers_relationships,
+    iter_all_follows,
+    get_followers_relationships,
+    Profile,
+    Relationships,
+    GET_RELATIONSHIPS_MAX_OTHERS,
+    GET_FOLLOWS_MAX_LIMIT,
+)
+from graph_tool.all import Graph, load_graph
+from dibuix import dibuixa_seguidors
+from punt_control import PuntControl
+from math import ceil
+from typing import Iterable
+import numpy as np
 import os
 
+ESTRATEGIES = ["auto", "relationships", "follows"]
 
-def build_followers_subgraph(client_handle: str) -> None:
+
+def _cost_relationships(seguidors: list[Profile], n_total: int) -> int:
+    """
+    Estima el nombre de peticions per descobrir les arestes amb getRelationships: cada seguidor es consulta contra tots els n_total seguidors en grups de GET_RELATIONSHIPS_MAX_OTHERS.
+    """
+    return len(seguidors) * ceil(n_total / GET_RELATIONSHIPS_MAX_OTHERS)
+
+
+def _cost_follows(seguidors: list[Profile]) -> int:
+    """
+    Estima el nombre de peticions per descobrir les arestes amb getFollows: cal paginar la llista de seguits de cada seguidor (followsCount) de GET_FOLLOWS_MAX_LIMIT en GET_FOLLOWS_MAX_LIMIT.
+    """
+    return sum(max(1, ceil(p.followsCount / GET_FOLLOWS_MAX_LIMIT)) for p in seguidors)
+
+
+def _seguits_per_seguidor(
+    seguidors: list[Profile], estrategia: str, punt: PuntControl
+) -> dict[str, list[str]]:
+    """
+    Retorna, per a cada DID de seguidor, la llista de DIDs de seguidors que segueix, fent servir l'estratègia indicada ('relationships' o 'follows').
+    Amb 'auto' tria la que necessita menys peticions a l'API segons l'estimació de cost.
+    Cada seguidor processat es desa al punt de control, i els que ja hi són no es tornen a consultar.
+    Els seguidors que l'API no ha pogut consultar (ex: comptes eliminats o suspesos) queden sense arestes de sortida i no es desen al punt de control, de manera que es tornen a provar si es reprèn el rastreig.
+    """
+    dids = [p.did for p in seguidors]
+    conjunt = set(dids)
+    fets = punt.carrega()
+    if fets:
+        print(f"Es reprèn el rastreig: {len(fets)} de {len(dids)} seguidors ja fets.")
+    pendents = [p for p in seguidors if p.did not in fets]
+    if estrategia == "auto":
+        cost_rel = _cost_relationships(pendents, len(dids))
+        cost_fol = _cost_follows(pendents)
+        estrategia = "follows" if cost_fol < cost_rel else "relationships"
+        print(
+            f"Cost estimat: {cost_rel} peticions (relationships), {cost_fol} peticions (follows). Es fa servir '{estrategia}'."
+        )
+    pendents_dids = [p.did for p in pendents]
+    errors: dict[str, Exception] = {}
+    if estrategia == "follows":
+        resultats = iter_all_follows(pendents_dids, errors)
+    elif estrategia == "relationships":
+        resultats = (
+            (did, rel.following)
+            for did, rel in iter_followers_relationships(pendents_dids, dids, errors)
+        )
+    else:
+        raise ValueError(f"Estratègia desconeguda: {estrategia} (opcions: {ESTRATEGIES})")
+    for did, seguits in resultats:
+        seguits = [d for d in seguits if d in conjunt]
+        if did not in errors:
+            punt.desa(did, seguits)
+        fets[did] = seguits
+    _avisa_errors(errors)
+    return fets
+
+
+def build_followers_subgraph(client_handle: str, estrategia: str = "auto") -> None:
     """
     Crea un subgraf dels seguidors d'un usuari, on cada node és un seguidor i les arestes representen relacions de seguiment entre ells.
-    Desa el graf en format .gt i SVG a la carpeta de resultats de l'usuari. Mostra informació bàsica per pantalla.
+    L'estratègia de descoberta d'arestes pot ser 'relationships', 'follows' o 'auto' (tria la de menor cost estimat en peticions).
+    El progrés es desa en un punt de control al costat del .gt: si el procés s'interromp, la següent execució continua on s'havia quedat.
+    Desa el graf en format .gt a la carpeta de resultats de l'usuari. Mostra informació bàsica per pantalla.
     """
-    followers = get_followers(client_handle)
-    dids = [p.did for p in followers]
+    followers: dict[str, Profile] = {}
+    # Només cal el perfil complet (followsCount) per estimar el cost de les estratègies
+    for prof in iter_followers(client_handle, detailed=estrategia == "auto"):
+        followers.setdefault(prof.did, prof)
+    punt = PuntControl(_fitxer_graf(client_handle) + ".checkpoint")
+    seguits = _seguits_per_seguidor(list(followers.values()), estrategia, punt)
+
+    # Els vèrtexs s'afegeixen de cop, en l'ordre de followers, i les arestes s'acumulen en arrays
+    did_a_index = {did: i for i, did in enumerate(followers)}
     g = Graph(directed=True)
-    vprop_did = g.new_vertex_property("string")
-    vprop_handle = g.new_vertex_property("string")
-    g.vertex_properties["did"] = vprop_did
-    g.vertex_properties["handle"] = vprop_handle
-    did_a_vertex = {}
-    for prof in followers:
-        v = g.add_vertex()
-        vprop_did[v] = prof.did
-        vprop_handle[v] = prof.handle
-        did_a_vertex[prof.did] = v
-    for did in dids:
-        rel = get_relationships(did, dids)
-        v_origen = did_a_vertex[did]
-        for dst_did in rel.following:
-            if dst_did in did_a_vertex and did != dst_did:
-                g.add_edge(v_origen, did_a_vertex[dst_did])
+    g.add_vertex(len(followers))
+    g.vertex_properties["did"] = g.new_vertex_property("string", vals=list(followers))
+    g.vertex_properties["handle"] = g.new_vertex_property(
+        "string", vals=[p.handle for p in followers.values()]
+    )
+    g.add_edge_list(_arestes(seguits.items(), did_a_index))
+    print(f"Nodes: {g.num_vertices()}, Arestes: {g.num_edges()}")
+    _desa_graf(g, client_handle)
+    punt.esborra()
+
+
+def update_followers_subgraph(client_handle: str) -> None:
+    """
+    Actualitza incrementalment el graf de seguidors desat: elimina els seguidors que han deixat de seguir l'usuari i afegeix els nous.
+    Només es consulten les relacions dels seguidors nous, entre ells i amb els que ja hi eren (getRelationships dona les dues direccions). El graf es desa al mateix fitxer.
+    Si el graf encara no existeix, es crea de zero amb build_followers_subgraph.
+    """
+    output_gt = _fitxer_graf(client_handle)
+    if not os.path.isfile(output_gt):
+        build_followers_subgraph(client_handle)
+        return
+    g = load_graph(output_gt)
+    # La llista de seguidors es demana sempre a l'API: la del magatzem o la memòria cau HTTP pot ser d'abans de l'últim graf
+    seguidors = {p.did: p for p in iter_followers(client_handle, fresh=True)}
+    vprop_did = g.vertex_properties["did"]
+    antics = {vprop_did[v] for v in g.vertices()}
+    marxats = [v for v in g.vertices() if vprop_did[v] not in seguidors]
+    if marxats:
+        g.remove_vertex(marxats)
+    nous = [p for did, p in seguidors.items() if did not in antics]
+    print(f"Seguidors nous: {len(nous)}, seguidors que han marxat: {len(marxats)}")
+    vprop_did = g.vertex_properties["did"]  # remove_vertex reordena els vèrtexs
+
+    # Els vèrtexs nous queden al final, amb índexs consecutius
+    dids = [vprop_did[v] for v in g.vertices()] + [p.did for p in nous]
+    did_a_index = {did: i for i, did in enumerate(dids)}
+    g.add_vertex(len(nous))
+    g.vertex_properties["did"] = g.new_vertex_property("string", vals=dids)
+    g.vertex_properties["handle"] = g.new_vertex_property(
+        "string", vals=[seguidors[did].handle for did in dids]  # El handle pot haver canviat
+    )
+
+    errors: dict[str, Exception] = {}
+    relacions = get_followers_relationships(
+        [p.did for p in nous], list(seguidors), errors
+    )
+    _avisa_errors(errors)
+    parelles = [(did, rel.following) for did, rel in relacions.items()]
+    parelles += [(src, [did]) for did, rel in relacions.items() for src in rel.followedBy]
+    arestes = np.unique(_arestes(parelles, did_a_index), axis=0)  # Una aresta pot sortir des dels dos extrems
+    g.add_edge_list(arestes)
     print(f"Nodes: {g.num_vertices()}, Arestes: {g.num_edges()}")
+    _desa_graf(g, client_handle)
+
+
+def _avisa_errors(errors: dict[str, Exception]) -> None:
+    """
+    Mostra quants seguidors no s'han pogut consultar i el primer error, si n'hi ha hagut algun.
+    """
+    if errors:
+        did, error = next(iter(errors.items()))
+        print(
+            f"Advertència: no s'han pogut consultar {len(errors)} seguidors (ex: {did}: {error})."
+        )
+
+
+def _arestes(
+    parelles: Iterable[tuple[str, list[str]]], did_a_index: dict[str, int]
+) -> np.ndarray:
+    """
+    Converteix parelles (DID d'origen, DIDs de destí) en un array Nx2 d'índexs de vèrtex, apte per a Graph.add_edge_list.
+    Es descarten els DIDs que no són al graf i els bucles.
+    """
+    origens: list[int] = []
+    destins: list[int] = []
+    for did, dst_dids in parelles:
+        if did not in did_a_index:
+            continue
+        indexs = [did_a_index[d] for d in dst_dids if d in did_a_index and d != did]
+        origens.extend([did_a_index[did]] * len(indexs))
+        destins.extend(indexs)
+    return np.column_stack(
+        (np.array(origens, dtype=np.int64), np.array(destins, dtype=np.int64))
+    )
+
+
+def _fitxer_graf(client_handle: str) -> str:
+    """
+    Retorna el camí del fitxer .gt del graf de seguidors d'un usuari (i crea la carpeta de resultats si cal).
+    """
     carpeta = os.path.join("resultats", client_handle)
     os.makedirs(carpeta, exist_ok=True)
-    output_gt = os.path.join(carpeta, f"{client_handle}_followers.gt")
+    return os.path.join(carpeta, f"{client_handle}_followers.gt")
+
+
+def _desa_graf(g: Graph, client_handle: str) -> None:
+    """
+    Desa el graf de seguidors en format .gt a la carpeta de resultats de l'usuari (el dibuix és una etapa a part, vegeu dibuix.py).
+    """
+    output_gt = _fitxer_graf(client_handle)
     g.save(output_gt)
     print(f"Graf guardat a: {output_gt}")
-    try:
-        output_svg = os.path.join(carpeta, f"seguidors_{client_handle}.svg")
-        graph_draw(
-            g,
-            vertex_shape="circle",
-            vertex_size=8,
-            edge_pen_width=1.2,
-            output_size=(1200, 1200),
-            bg_color="white",
-            output=output_svg,
-        )
-        print(f"Imatge SVG del graf desada a: {output_svg}")
-    except Exception as e:
-        print(f"No s'ha pogut generar l'SVG: {e}")
 
 
 def main() -> None:
     """
     Permet executar el mòdul des de la línia de comandes per generar el graf de seguidors d'un usuari.
-    Demana el handle per entrada o com a argument, i desa els resultats a la carpeta corresponent.
+    Demana el handle per entrada o com a argument (opcionalment seguit de l'estratègia de descoberta d'arestes), i desa els resultats (graf i dibuix) a la carpeta corresponent.
     """
     import sys
     if len(sys.argv) > 1:
@@ -61,7 +208,9 @@ def main() -> None:
         client_handle = input(
             "Introdueix el handle de l'usuari (ex: user.bsky.social): "
         ).strip()
-    build_followers_subgraph(client_handle)
+    estrategia = sys.argv[2].strip() if len(sys.argv) > 2 else "auto"
+    build_followers_subgraph(client_handle, estrategia)
+    dibuixa_seguidors(client_handle)
 
 
 if __name__ == "__main__":
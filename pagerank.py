@@ -1,4 +1,14 @@
-from graph_tool.all import load_graph, pagerank, betweenness, closeness
+from graph_tool.all import (
+    GraphView,
+    load_graph,
+    openmp_set_num_threads,
+    pagerank,
+    betweenness,
+    closeness,
+    shortest_distance,
+)
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import os
@@ -6,17 +16,84 @@ import matplotlib
 
 matplotlib.use("Agg")
 
+MODES = ["auto", "exacte", "aproximat"]
+# En mode 'auto', per sobre d'aquest nombre de nodes betweenness i closeness s'aproximen
+MAX_NODES_EXACTE = 5000
+# Nombre de vèrtexs pivot (mostra) per a les centralitats aproximades
+NUM_PIVOTS = 500
 
-def main(handle=None):
+
+def closeness_aproximada(g, pivots):
+    """
+    Estima la closeness de tots els nodes a partir de cerques en amplada des dels pivots sobre el graf invertit:
+    cada cerca dona la distància de tots els nodes al pivot, i la closeness de cada node és l'invers de la seva distància mitjana als pivots que pot assolir (com closeness(g), normalitzada).
+    Els nodes que no assoleixen cap pivot queden sense valor (NaN).
+    """
+    n = g.num_vertices()
+    invers = GraphView(g, reversed=True)
+    suma = np.zeros(n)
+    abastats = np.zeros(n)
+    for p in pivots:
+        d = shortest_distance(invers, source=invers.vertex(p)).a
+        abastables = (d > 0) & (d < n)  # Els nodes que no arriben al pivot tenen distància "infinita"
+        suma[abastables] += d[abastables]
+        abastats[abastables] += 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(abastats > 0, abastats / suma, np.nan)
+
+
+def calcula_centralitats(g, mode="auto", num_pivots=NUM_PIVOTS, fils_openmp=None):
+    """
+    Calcula el PageRank, la betweenness i la closeness dels nodes. Les tres mesures són independents i es calculen alhora en fils diferents (graph-tool allibera el GIL).
+    Betweenness i closeness poden ser exactes o aproximades amb una mostra de num_pivots vèrtexs pivot; en mode 'auto' s'aproxima quan el graf té més de MAX_NODES_EXACTE nodes.
+    fils_openmp fixa els fils OpenMP de graph-tool de cada mesura; per defecte es reparteixen els nuclis entre les tres. El valor és per fil, i per això el fixa cada tasca al seu fil treballador (el del fil principal no canvia).
+    Retorna (pagerank, betweenness, closeness, mode, mida de la mostra), amb les mesures com a arrays indexats per vèrtex.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Mode desconegut: {mode} (opcions: {MODES})")
+    n = g.num_vertices()
+    if mode == "auto":
+        mode = "aproximat" if n > MAX_NODES_EXACTE else "exacte"
+    if mode == "exacte" or num_pivots >= n:
+        mode, pivots = "exacte", None
+    else:
+        pivots = np.random.choice(n, num_pivots, replace=False)
+    if fils_openmp is None:
+        fils_openmp = max(1, (os.cpu_count() or 1) // 3)
+
+    def _amb_fils(calcul):
+        openmp_set_num_threads(fils_openmp)
+        return calcul()
+
+    def _closeness():
+        if pivots is None:
+            return closeness(g).a
+        return closeness_aproximada(g, pivots)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        pr = executor.submit(_amb_fils, lambda: pagerank(g).a)
+        bc = executor.submit(_amb_fils, lambda: betweenness(g, pivots=pivots)[0].a)
+        cc = executor.submit(_amb_fils, _closeness)
+        resultats = pr.result(), bc.result(), cc.result()
+    return (*resultats, mode, n if pivots is None else len(pivots))
+
+
+def main(handle=None, mode="auto", num_pivots=NUM_PIVOTS, fils_openmp=None):
     """
     Calcula i exporta les centralitats (PageRank, Betweenness, Closeness) per als nodes del graf de seguidors d'un usuari.
     Si el graf no existeix, l'intenta generar automàticament. Desa els resultats i gràfics a la carpeta de resultats.
+    Betweenness i closeness poden ser exactes o aproximades per mostreig de pivots (vegeu calcula_centralitats); el CSV indica el mode i la mida de la mostra.
+    Des de la línia de comandes, el handle pot anar seguit del mode i del nombre de pivots (ex: pagerank.py user.bsky.social aproximat 1000).
     """
     import sys  # Només necessari dins de main
 
     if handle is None:
         if len(sys.argv) > 1:
             handle = sys.argv[1].strip()
+            if len(sys.argv) > 2:
+                mode = sys.argv[2].strip()
+            if len(sys.argv) > 3:
+                num_pivots = int(sys.argv[3])
         else:
             handle = input(
                 "Introdueix el handle de l'usuari (ex: user.bsky.social): "
@@ -50,21 +127,23 @@ def main(handle=None):
         )
         return
 
-    pr = pagerank(g)
-    bc, _ = betweenness(g)
-    cc = closeness(g)
-
-    dades = []
-    for v in g.vertices():
-        dades.append(
-            {
-                "id": int(v),
-                "PageRank": float(pr[v]),
-                "Betweenness": float(bc[v]),
-                "Closeness": float(cc[v]),
-            }
-        )
-    df = pd.DataFrame(dades)
+    pr, bc, cc, mode, mostra = calcula_centralitats(g, mode, num_pivots, fils_openmp)
+    print(f"Betweenness i closeness en mode {mode} ({mostra} pivots de {g.num_vertices()} nodes).")
+
+    df = pd.DataFrame(
+        {
+            "id": np.arange(g.num_vertices()),
+            "PageRank": pr,
+            "Betweenness": bc,
+            "Closeness": cc,
+            "mode": mode,
+            "pivots": mostra,
+        }
+    )
+    for nom in ["did", "handle"]:
+        if nom in g.vertex_properties:
+            vprop = g.vertex_properties[nom]
+            df.insert(1, nom, [vprop[v] for v in g.vertices()])
     csv_path = os.path.join(carpeta, "centralitats_seguidors.csv")
     df.to_csv(csv_path, index=False)
     print(f"Centralitats exportades a: {csv_path}")
@@ -0,0 +1,51 @@
+import json
+import os
+from typing import Any, Optional, TextIO
+
+
+class PuntControl:
+    """
+    Fitxer de punt de control d'un rastreig llarg: cada línia és un objecte JSON amb la clau d'un element ja processat i el seu resultat.
+    Cada línia es força a disc en escriure-la, de manera que una execució interrompuda es pot reprendre des de l'últim element desat.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fitxer: Optional[TextIO] = None
+
+    def carrega(self) -> dict[str, Any]:
+        """
+        Retorna un diccionari amb els resultats desats fins ara (buit si no hi ha cap punt de control).
+        Les línies incompletes (per exemple, si el procés es va aturar mentre escrivia) s'ignoren.
+        """
+        resultats: dict[str, Any] = {}
+        if not os.path.isfile(self.path):
+            return resultats
+        with open(self.path) as f:
+            for linia in f:
+                try:
+                    entrada = json.loads(linia)
+                except json.JSONDecodeError:
+                    continue
+                resultats[entrada["clau"]] = entrada["valor"]
+        return resultats
+
+    def desa(self, clau: str, valor: Any) -> None:
+        """
+        Afegeix el resultat d'un element al punt de control i el força a disc.
+        """
+        if self.fitxer is None:
+            self.fitxer = open(self.path, "a")
+        self.fitxer.write(json.dumps({"clau": clau, "valor": valor}) + "\n")
+        self.fitxer.flush()
+        os.fsync(self.fitxer.fileno())
+
+    def esborra(self) -> None:
+        """
+        Elimina el punt de control, un cop el rastreig ha acabat correctament.
+        """
+        if self.fitxer is not None:
+            self.fitxer.close()
+            self.fitxer = None
+        if os.path.isfile(self.path):
+            os.remove(self.path)
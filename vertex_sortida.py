@@ -1,5 +1,5 @@
 from typing import Set, List
-from bsky import get_follower_handles
+from bsky import iter_followers
 from graph_tool.all import Graph, load_graph
 from graf_interaccio_threads import _get_client_threads, build_interaction_graph
 import matplotlib
@@ -30,7 +30,7 @@ def identifica_seguidors_valuosos(client_handle: str) -> None:
         return
 
     # --- Extraiem seguidors directes del client ---
-    seguidors_directes: Set[str] = set(get_follower_handles(client_handle))
+    seguidors_directes: Set[str] = {p.handle for p in iter_followers(client_handle)}
 
     # --- Analitzem comportament dels seguidors al graf de threads ---
     dades: List[dict[str, str | int | float]] = []